@@ -0,0 +1,59 @@
+"""
+Benchmark the sensor and metrics update loop on a host with mock buses:
+
+    python bench.py [updates]
+
+Board time is the virtual time the update would spend on bus transfers and
+sleeps on the device; host time is the CPython time spent in driver and
+aggregation code.
+"""
+
+import sys
+import time
+
+import mock
+
+clock = mock.install()
+
+import bme680, c8d, history, mhz19, prometheus, sensors
+
+
+def build():
+    bme_spi = mock.SPI(mock.BME680(clock), clock)
+    mhz_uart = mock.UART(mock.MHZ19(), clock)
+    c8d_uart = mock.UART(mock.C8D(), clock)
+    s = sensors.Sensors(
+        bme=bme680.BME680(2, 5, spi=bme_spi, cs=mock.Pin(1)),
+        mhz=mhz19.MHZ19(1, uart=mhz_uart),
+        c8d=c8d.C8D(2, uart=c8d_uart),
+        history=history.History(),
+    )
+    return s, prometheus.Prometheus(), (bme_spi, mhz_uart, c8d_uart)
+
+
+def main(updates=1000):
+    s, p, buses = build()
+
+    board = 0
+    host = time.perf_counter()
+    transfers = [b.transfers for b in buses]
+    for _ in range(updates):
+        # step past the UART sensors' refresh interval, as the update timer would
+        clock.sleep_ms(15000)
+        start = clock.now
+        s.update()
+        p.update(s)
+        p.registry.encode()
+        board += clock.now - start
+    host = time.perf_counter() - host
+
+    print('updates:             {}'.format(updates))
+    print('board time/update:   {:.2f} ms'.format(board / updates / 1000))
+    print('host time/update:    {:.3f} ms'.format(host / updates * 1000))
+    print('host updates/s:      {:.0f}'.format(updates / host))
+    for name, bus, before in zip(('bme680 spi', 'mhz19 uart', 'c8d uart'), buses, transfers):
+        print('{:20} {:.1f} transfers/update'.format(name + ':', (bus.transfers - before) / updates))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -1,7 +1,8 @@
-import machine
 import struct
 from time import sleep_ms
 
+import hal
+
 _BME280_CHIPID = const(0x60)
 _BME280_REGISTER_CHIPID = const(0xD0)
 OVERSCAN_X1 = const(0x01)  # overscan for temp, humidity
@@ -23,9 +24,9 @@ _BME280_REGISTER_TEMPDATA = const(0xFA)
 _BME280_REGISTER_HUMIDDATA = const(0xFD)
 
 class BME280:
-    def __init__(self, spi_id, cs_pin):
-        self._spi = machine.SPI(spi_id, 100_000)
-        self._cs = machine.Pin(cs_pin, machine.Pin.OUT)
+    def __init__(self, spi_id, cs_pin, spi=None, cs=None):
+        self._spi = spi if spi != None else hal.spi(spi_id, 100_000)
+        self._cs = cs if cs != None else hal.pin_out(cs_pin)
         # Set some reasonable defaults.
         self._iir_filter = IIR_FILTER_DISABLE
         self._t_standby = 0x02  # 125ms
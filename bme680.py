@@ -1,7 +1,16 @@
-import machine
 import math
 import struct
 import time
+from collections import namedtuple
+
+import bme680_compensation as compensation
+import hal
+import iaq
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 _BME680_CHIPID = const(0x61)
 
@@ -29,57 +38,24 @@ _BME680_SAMPLERATES = (0, 1, 2, 4, 8, 16)
 _BME680_FILTERSIZES = (0, 1, 3, 7, 15, 31, 63, 127)
 
 _BME680_RUNGAS = const(0x10)
+_BME680_NEW_DATA = const(0x80)
+_BME680_HEAT_STAB = const(0x10)
+
+# TPHG timing from the BME680 datasheet, in microseconds
+_BME680_MEAS_CYCLE_US = const(1963)  # per oversampled T, P or H conversion
+_BME680_MEAS_OFFSET_US = const(477 * 4 + 477 * 5 + 500)  # TPH switching, gas measurement and rounding to ms
+_BME680_POLL_INTERVAL = const(5)  # ms between status polls once a measurement is overdue
 
-_IAQ_GAS_REFERENCE = const(2500.0)
-_IAQ_HUMIDITY_REFERENCE = const(40.0)
-#_IAQ_GAS_LOWER_LIMIT = const(10000.0)
-#_IAQ_GAS_UPPER_LIMIT = const(300000.0)
-_IAQ_GAS_LOWER_LIMIT = const(2000.0)
-_IAQ_GAS_UPPER_LIMIT = const(50000.0)
-
-# lookup tables for gas resistance calculation
-_LOOKUP_TABLE_1 = (
-    2147483647.0,
-    2147483647.0,
-    2147483647.0,
-    2147483647.0,
-    2147483647.0,
-    2126008810.0,
-    2147483647.0,
-    2130303777.0,
-    2147483647.0,
-    2147483647.0,
-    2143188679.0,
-    2136746228.0,
-    2147483647.0,
-    2126008810.0,
-    2147483647.0,
-    2147483647.0,
-)
-
-_LOOKUP_TABLE_2 = (
-    4096000000.0,
-    2048000000.0,
-    1024000000.0,
-    512000000.0,
-    255744255.0,
-    127110228.0,
-    64000000.0,
-    32258064.0,
-    16016016.0,
-    8000000.0,
-    4000000.0,
-    2000000.0,
-    1000000.0,
-    500000.0,
-    250000.0,
-    125000.0,
-)
+_BME680_HEATER_TEMP = const(0x73)  # 320 degrees C
+_BME680_HEATER_WAIT = const(0x65)  # 148ms
+
+# one forced measurement, compensated as a whole
+Reading = namedtuple('Reading', ('temperature', 'pressure', 'humidity', 'gas_resistance', 'indoor_air_quality', 'iaq_accuracy'))
 
 class BME680:
-    def __init__(self, spi_id, cs_pin, refresh_rate: int = 100, t_fine_offset: float = 0, temp_offset: float = 0, humidity_offset: float = 0, debug: bool = False):
-        self._spi = machine.SPI(spi_id, 100_000)
-        self._cs = machine.Pin(cs_pin, machine.Pin.OUT)
+    def __init__(self, spi_id, cs_pin, refresh_rate: int = 100, t_fine_offset: float = 0, temp_offset: float = 0, humidity_offset: float = 0, debug: bool = False, estimator: iaq.IAQ = None, spi=None, cs=None):
+        self._spi = spi if spi != None else hal.spi(spi_id, 100_000)
+        self._cs = cs if cs != None else hal.pin_out(cs_pin)
 
         self._pressure_oversample = 0b011
         self._temp_oversample = 0b100
@@ -91,18 +67,32 @@ class BME680:
         self._adc_hum = None
         self._adc_gas = None
         self._gas_range = None
-        self._gas_reference = _IAQ_GAS_REFERENCE
+        # fed every heat stable gas reading, pass one with a path to keep its baseline across reboots
+        self._iaq = estimator if estimator != None else iaq.IAQ()
         self._t_fine = None
         self.set_temperature_offset(t_fine_offset)
         self._temp_offset = temp_offset
         self._humidity_offset = humidity_offset
 
         self._last_reading = 0
+        self._measuring = False
+        self._measure_start = 0
+        self._measure_duration = 0
         self._min_refresh_time = refresh_rate
         self._debug = debug
         self.sea_level_pressure = 1013.25
 
+        # transfer buffers are reused by every register access
+        self._cmd = bytearray(1)
+        self._page = bytearray((_BME680_REG_STATUS, 0))
+        self._rx = bytearray(25)  # longest read is the first calibration block
+        self._rx_view = memoryview(self._rx)
+        self._tx = bytearray(8)  # up to 4 (register, value) pairs
+        self._tx_view = memoryview(self._tx)
+        self._spi_mem_page = None  # unknown until first set
+
         self._write(_BME680_REG_SOFTRESET, [0xB6])
+        self._spi_mem_page = None  # reset returns to page 0 but don't rely on it
         time.sleep_ms(10)
 
         # Check device ID.
@@ -116,8 +106,8 @@ class BME680:
         self._read_calibration()
 
         # set up gas heater
-        self._write(_BME680_BME680_RES_HEAT_0, [0x73])  # 320 degrees C
-        self._write(_BME680_BME680_GAS_WAIT_0, [0x65])  # 148ms
+        self._write(_BME680_BME680_RES_HEAT_0, [_BME680_HEATER_TEMP])
+        self._write(_BME680_BME680_GAS_WAIT_0, [_BME680_HEATER_WAIT])
 
     def set_temperature_offset(self, value):
         """Set temperature offset in degrees Celsius.
@@ -128,98 +118,42 @@ class BME680:
             self._t_fine_offset = 0
         else:
             self._t_fine_offset = int(math.copysign((((int(abs(value) * 100)) << 8) - 128) / 5, value))
+        if hasattr(self, '_calibration'):
+            self._calibration.t_fine_offset = self._t_fine_offset
+
+    @property
+    def calibration(self) -> compensation.Calibration:
+        """Compensation coefficients and offsets, for use with compensation.compensate"""
+        return self._calibration
+
+    def raw(self) -> tuple:
+        """Uncompensated (adc_temp, adc_pres, adc_hum, adc_gas, gas_range) of a reading"""
+        self._perform_reading()
+        return (self._adc_temp, self._adc_pres, self._adc_hum, self._adc_gas, self._gas_range)
 
     @property
     def temperature(self) -> float:
         """The compensated temperature in degrees Celsius."""
         self._perform_reading()
-        calc_temp = ((self._t_fine * 5) + 128) / 256
-        return (calc_temp / 100) + self._temp_offset
+        return compensation.temperature(self._calibration, self._t_fine)
 
     @property
     def pressure(self) -> float:
         """The barometric pressure in hectoPascals"""
         self._perform_reading()
-        var1 = (self._t_fine / 2) - 64000
-        var2 = ((var1 / 4) * (var1 / 4)) / 2048
-        var2 = (var2 * self._pressure_calibration[5]) / 4
-        var2 = var2 + (var1 * self._pressure_calibration[4] * 2)
-        var2 = (var2 / 4) + (self._pressure_calibration[3] * 65536)
-        var1 = (
-            (((var1 / 4) * (var1 / 4)) / 8192)
-            * (self._pressure_calibration[2] * 32)
-            / 8
-        ) + ((self._pressure_calibration[1] * var1) / 2)
-        var1 = var1 / 262144
-        var1 = ((32768 + var1) * self._pressure_calibration[0]) / 32768
-        calc_pres = 1048576 - self._adc_pres
-        calc_pres = (calc_pres - (var2 / 4096)) * 3125
-        calc_pres = (calc_pres / var1) * 2
-        var1 = (
-            self._pressure_calibration[8] * (((calc_pres / 8) * (calc_pres / 8)) / 8192)
-        ) / 4096
-        var2 = ((calc_pres / 4) * self._pressure_calibration[7]) / 8192
-        var3 = (((calc_pres / 256) ** 3) * self._pressure_calibration[9]) / 131072
-        calc_pres += (var1 + var2 + var3 + (self._pressure_calibration[6] * 128)) / 16
-        return calc_pres / 100
+        return compensation.pressure(self._calibration, self._t_fine, self._adc_pres)
 
     @property
     def humidity(self) -> float:
         """The relative humidity in RH %"""
         self._perform_reading()
-        temp_scaled = ((self._t_fine * 5) + 128) / 256
-        var1 = (self._adc_hum - (self._humidity_calibration[0] * 16)) - (
-            (temp_scaled * self._humidity_calibration[2]) / 200
-        )
-        var2 = (
-            self._humidity_calibration[1]
-            * (
-                ((temp_scaled * self._humidity_calibration[3]) / 100)
-                + (
-                    (
-                        (
-                            temp_scaled
-                            * ((temp_scaled * self._humidity_calibration[4]) / 100)
-                        )
-                        / 64
-                    )
-                    / 100
-                )
-                + 16384
-            )
-        ) / 1024
-        var3 = var1 * var2
-        var4 = self._humidity_calibration[5] * 128
-        var4 = (var4 + ((temp_scaled * self._humidity_calibration[6]) / 100)) / 16
-        var5 = ((var3 / 16384) * (var3 / 16384)) / 1024
-        var6 = (var4 * var5) / 2
-        calc_hum = (((var3 + var6) / 1024) * 1000) / 4096
-        calc_hum /= 1000  # get back to RH
-
-        calc_hum = min(calc_hum, 100)
-        calc_hum = max(calc_hum, 0)
-        return calc_hum + self._humidity_offset
+        return compensation.humidity(self._calibration, self._t_fine, self._adc_hum)
 
     @property
     def gas_resistance(self) -> int:
         """The gas resistance in ohms"""
         self._perform_reading()
-        if self._chip_variant == 0x01:
-            # taken from https://github.com/BoschSensortec/BME68x-Sensor-API
-            var1 = 262144 >> self._gas_range
-            var2 = self._adc_gas - 512
-            var2 *= 3
-            var2 = 4096 + var2
-            calc_gas_res = (1000 * var1) / var2
-            calc_gas_res = calc_gas_res * 100
-        else:
-            var1 = (
-                (1340 + (5 * self._sw_err)) * (_LOOKUP_TABLE_1[self._gas_range])
-            ) / 65536
-            var2 = ((self._adc_gas * 32768) - 16777216) + var1
-            var3 = (_LOOKUP_TABLE_2[self._gas_range] * var1) / 512
-            calc_gas_res = (var3 + (var2 / 2)) / var2
-        return int(calc_gas_res)
+        return compensation.gas_resistance(self._calibration, self._adc_gas, self._gas_range)
 
     def burn_in(self, count=10) -> None:
         for i in range(count):
@@ -228,25 +162,101 @@ class BME680:
 
     @property
     def indoor_air_quality(self) -> float:
-        readings = 5
-        for i in range(readings):
-            self._gas_reference += self.gas_resistance
-            time.sleep_ms(self._min_refresh_time+2)
-        self._gas_reference /= readings
-        gas_score = ((0.75 / (_IAQ_GAS_UPPER_LIMIT - _IAQ_GAS_LOWER_LIMIT) * self._gas_reference) - (_IAQ_GAS_LOWER_LIMIT * (0.75 / (_IAQ_GAS_UPPER_LIMIT - _IAQ_GAS_LOWER_LIMIT)))) * 100.0
-        if gas_score > 75:
-            gas_score = 75
-        elif gas_score < 0:
-            gas_score = 0
-
-        humidity_score = 25.0
-        humidity = self.humidity
-        if humidity < 38:
-            humidity_score = 0.25 / _IAQ_HUMIDITY_REFERENCE * humidity * 100.0
-        elif humidity > 42:
-            humidity_score = ((-0.25 / (100 - _IAQ_HUMIDITY_REFERENCE) * humidity) + 0.416666) * 100.0
-
-        return (100.0 - gas_score - humidity_score) * 5.0
+        """Indoor air quality score from 0 (clean) to 500, NaN until the heater has been stable"""
+        self._perform_reading()
+        return self._iaq.score
+
+    @property
+    def iaq_accuracy(self) -> int:
+        """Confidence in indoor_air_quality from 0 (burning in) to 3"""
+        self._perform_reading()
+        return self._iaq.accuracy
+
+    def measurement_duration(self) -> int:
+        """Expected length in ms of a forced TPHG measurement with the current
+        oversampling and heater settings"""
+        cycles = (
+            _BME680_SAMPLERATES[self._temp_oversample]
+            + _BME680_SAMPLERATES[self._pressure_oversample]
+            + _BME680_SAMPLERATES[self._humidity_oversample]
+        )
+        tph = (cycles * _BME680_MEAS_CYCLE_US + _BME680_MEAS_OFFSET_US) // 1000 + 1  # 1ms to wake up
+        # gas_wait is 6 bits of ms with a 2 bit multiplier of 1, 4, 16 or 64
+        heater = (_BME680_HEATER_WAIT & 0x3F) << (2 * (_BME680_HEATER_WAIT >> 6))
+        return tph + heater
+
+    def start_measurement(self) -> int:
+        """Trigger a forced mode measurement without waiting for it. Returns the
+        expected duration in ms, after which poll() should find it complete."""
+        # all control registers share a memory page, so configure and
+        # trigger in one burst; ctrl_hum only applies once ctrl_meas is written
+        tx = self._tx
+        # set filter
+        tx[0] = _BME680_REG_CONFIG
+        tx[1] = self._filter << 2
+        # turn on humidity oversample
+        tx[2] = _BME680_REG_CTRL_HUM
+        tx[3] = self._humidity_oversample
+        # gas measurements enabled
+        tx[4] = _BME680_REG_CTRL_GAS
+        tx[5] = _BME680_RUNGAS << 1 if self._chip_variant == 0x01 else _BME680_RUNGAS
+        # turn on temp oversample & pressure oversample, and enable single shot!
+        tx[6] = _BME680_REG_CTRL_MEAS
+        tx[7] = (self._temp_oversample << 5) | (self._pressure_oversample << 2) | 0x01
+        self._write_pairs(4)
+
+        self._measuring = True
+        self._measure_start = time.ticks_ms()
+        self._measure_duration = self.measurement_duration()
+        return self._measure_duration
+
+    def poll(self) -> bool:
+        """Check on a started measurement without blocking. The sensor is only
+        read once the expected duration has passed; returns True once new data
+        has been read."""
+        if not self._measuring:
+            return False
+        if time.ticks_diff(time.ticks_ms(), self._measure_start) < self._measure_duration:
+            return False
+
+        data = self._read(_BME680_REG_MEAS_STATUS, 17)
+        if data[0] & _BME680_NEW_DATA == 0:
+            return False
+
+        self._measuring = False
+        self._last_reading = time.ticks_ms()
+        self._parse_reading(data)
+        return True
+
+    async def read(self) -> Reading:
+        """Perform a forced measurement, yielding to other tasks while the
+        sensor converts and heats the gas plate"""
+        await asyncio.sleep(self.start_measurement() / 1000)
+        while not self.poll():
+            await asyncio.sleep(_BME680_POLL_INTERVAL / 1000)
+        return self._reading()
+
+    def measure(self) -> Reading:
+        """Perform exactly one forced measurement, blocking until it completes"""
+        self._measure()
+        return self._reading()
+
+    def _measure(self) -> None:
+        time.sleep_ms(self.start_measurement())
+        while not self.poll():
+            time.sleep_ms(_BME680_POLL_INTERVAL)
+
+    def _reading(self) -> Reading:
+        """Compensate every channel of the last measurement"""
+        cal = self._calibration
+        return Reading(
+            compensation.temperature(cal, self._t_fine),
+            compensation.pressure(cal, self._t_fine, self._adc_pres),
+            compensation.humidity(cal, self._t_fine, self._adc_hum),
+            compensation.gas_resistance(cal, self._adc_gas, self._gas_range),
+            self._iaq.score,
+            self._iaq.accuracy,
+        )
 
     def _perform_reading(self) -> None:
         """Perform a single-shot reading from the sensor and fill internal data structure for
@@ -255,30 +265,10 @@ class BME680:
             return
 
         time.sleep_ms(2)
-        # set filter
-        self._write(_BME680_REG_CONFIG, [self._filter << 2])
-        # turn on humidity oversample
-        self._write(_BME680_REG_CTRL_HUM, [self._humidity_oversample])
-        # turn on temp oversample & pressure oversample
-        self._write(
-            _BME680_REG_CTRL_MEAS,
-            [(self._temp_oversample << 5) | (self._pressure_oversample << 2)],
-        )
-        # gas measurements enabled
-        if self._chip_variant == 0x01:
-            self._write(_BME680_REG_CTRL_GAS, [_BME680_RUNGAS << 1])
-        else:
-            self._write(_BME680_REG_CTRL_GAS, [_BME680_RUNGAS])
-        ctrl = self._read(_BME680_REG_CTRL_MEAS, 1)[0]
-        ctrl = (ctrl & 0xFC) | 0x01  # enable single shot!
-        self._write(_BME680_REG_CTRL_MEAS, [ctrl])
-        new_data = False
-        while not new_data:
-            data = self._read(_BME680_REG_MEAS_STATUS, 17)
-            new_data = data[0] & 0x80 != 0
-            time.sleep_ms(5)
-        self._last_reading = time.ticks_ms()
+        self._measure()
 
+    def _parse_reading(self, data) -> None:
+        """Unpack raw ADC values from the 17 bytes starting at the measurement status"""
         self._adc_pres = (data[2] << 12) + (data[3] << 4) + (data[4] >> 4)
         self._adc_temp = (data[5] << 12) + (data[6] << 4) + (data[7] >> 4)
 
@@ -286,20 +276,24 @@ class BME680:
         if self._chip_variant == 0x01:
             self._adc_gas = int(struct.unpack(">H", bytes(data[15:17]))[0] / 64)
             self._gas_range = data[16] & 0x0F
+            heat_stable = data[16] & _BME680_HEAT_STAB != 0
         else:
             self._adc_gas = int(struct.unpack(">H", bytes(data[13:15]))[0] / 64)
             self._gas_range = data[14] & 0x0F
+            heat_stable = data[14] & _BME680_HEAT_STAB != 0
+
+        self._t_fine = compensation.t_fine(self._calibration, self._adc_temp)
 
-        var1 = (self._adc_temp / 8) - (self._temp_calibration[0] * 2)
-        var2 = (var1 * self._temp_calibration[1]) / 2048
-        var3 = ((var1 / 2) * (var1 / 2)) / 4096
-        var3 = (var3 * self._temp_calibration[2] * 16) / 16384
-        self._t_fine = int(var2 + var3) + self._t_fine_offset
+        if heat_stable:
+            self._iaq.update(
+                compensation.gas_resistance(self._calibration, self._adc_gas, self._gas_range),
+                compensation.humidity(self._calibration, self._t_fine, self._adc_hum),
+            )
 
     def _read_calibration(self) -> None:
         """Read & save the calibration coefficients"""
-        coeff = self._read(_BME680_BME680_COEFF_ADDR1, 25)
-        coeff += self._read(_BME680_BME680_COEFF_ADDR2, 16)
+        coeff = bytes(self._read(_BME680_BME680_COEFF_ADDR1, 25))
+        coeff += bytes(self._read(_BME680_BME680_COEFF_ADDR2, 16))
 
         coeff = list(struct.unpack("<hbBHhbBhhbbHhhBBBHbbbBbHhbb", bytes(coeff[1:39])))
         coeff = [float(i) for i in coeff]
@@ -319,44 +313,66 @@ class BME680:
         self._heat_val = self._read(0x00, 1)[0]
         self._sw_err = (self._read(0x04, 1)[0] & 0xF0) / 16
 
-    def _read(self, register: int, length: int) -> bytearray:
-        if register != _BME680_REG_STATUS:
-            # _BME680_REG_STATUS exists in both SPI memory pages
-            # For all other registers, we must set the correct memory page
-            self._set_spi_mem_page(register)
+        self._calibration = compensation.Calibration(
+            self._temp_calibration,
+            self._pressure_calibration,
+            self._humidity_calibration,
+            self._sw_err,
+            self._chip_variant,
+            self._t_fine_offset,
+            self._temp_offset,
+            self._humidity_offset,
+        )
+
+    def _read(self, register: int, length: int) -> memoryview:
+        """Read length bytes starting at register into the shared receive buffer.
+        The result is only valid until the next read."""
+        self._set_spi_mem_page(register)
 
-        register = (register | 0x80) & 0xFF  # Read, bit 7 high
+        self._cmd[0] = (register | 0x80) & 0xFF  # Read, bit 7 high
+        result = self._rx_view[:length]
         self._cs(0)
-        self._spi.write(bytearray([register]))
-        result = bytearray(length)
+        self._spi.write(self._cmd)
         self._spi.readinto(result)
         self._cs(1)
         if self._debug:
-            print("\t$%02X => %s" % (register, [hex(i) for i in result]))
+            print("\t$%02X => %s" % (self._cmd[0], [hex(i) for i in result]))
         return result
 
     def _write(self, register: int, values) -> None:
-        if register != _BME680_REG_STATUS:
-            # _BME680_REG_STATUS exists in both SPI memory pages
-            # For all other registers, we must set the correct memory page
-            self._set_spi_mem_page(register)
-
-        register &= 0x7F  # Write, bit 7 low
-        buffer = bytearray(2 * len(values))
+        """Write values to consecutive registers starting at register"""
         for i, value in enumerate(values):
-            buffer[2 * i] = register + i
-            buffer[2 * i + 1] = value & 0xFF
+            self._tx[2 * i] = register + i
+            self._tx[2 * i + 1] = value & 0xFF
+        self._write_pairs(len(values))
+
+    def _write_pairs(self, count: int) -> None:
+        """Send the first count (register, value) pairs of the transmit buffer in
+        one transaction. All registers must be in the same memory page."""
+        self._set_spi_mem_page(self._tx[0])
+
+        for i in range(count):
+            self._tx[2 * i] &= 0x7F  # Write, bit 7 low
         self._cs(0)
-        self._spi.write(buffer)
+        self._spi.write(self._tx_view[:2 * count])
         self._cs(1)
         if self._debug:
-            print("\t$%02X <= %s" % (buffer[0], [hex(i) for i in buffer[1:]]))
+            print("\t$%02X <= %s" % (self._tx[0], [hex(i) for i in self._tx_view[1:2 * count]]))
 
     def _set_spi_mem_page(self, register: int) -> None:
+        if register == _BME680_REG_STATUS:
+            # _BME680_REG_STATUS exists in both SPI memory pages
+            return
+
+        # For all other registers, we must set the correct memory page
         spi_mem_page = 0x00
         if register < 0x80:
             spi_mem_page = 0x10
+        if spi_mem_page == self._spi_mem_page:
+            return
+
+        self._page[1] = spi_mem_page
         self._cs(0)
-        self._write(_BME680_REG_STATUS, [spi_mem_page])
+        self._spi.write(self._page)
         self._cs(1)
-
+        self._spi_mem_page = spi_mem_page
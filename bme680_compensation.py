@@ -0,0 +1,223 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# lookup tables for gas resistance calculation
+_LOOKUP_TABLE_1 = (
+    2147483647.0,
+    2147483647.0,
+    2147483647.0,
+    2147483647.0,
+    2147483647.0,
+    2126008810.0,
+    2147483647.0,
+    2130303777.0,
+    2147483647.0,
+    2147483647.0,
+    2143188679.0,
+    2136746228.0,
+    2147483647.0,
+    2126008810.0,
+    2147483647.0,
+    2147483647.0,
+)
+
+_LOOKUP_TABLE_2 = (
+    4096000000.0,
+    2048000000.0,
+    1024000000.0,
+    512000000.0,
+    255744255.0,
+    127110228.0,
+    64000000.0,
+    32258064.0,
+    16016016.0,
+    8000000.0,
+    4000000.0,
+    2000000.0,
+    1000000.0,
+    500000.0,
+    250000.0,
+    125000.0,
+)
+
+
+class Calibration():
+    """
+    Per-device compensation coefficients of a BME680, as read from its
+    calibration registers, plus the driver's configured offsets. Keep one with
+    logged raw samples to reprocess them later.
+    """
+    def __init__(self, temp, pressure, humidity, sw_err, variant, t_fine_offset=0, temp_offset=0.0, humidity_offset=0.0):
+        self.temp = temp
+        self.pressure = pressure
+        self.humidity = humidity
+        self.sw_err = sw_err
+        self.variant = variant
+        self.t_fine_offset = t_fine_offset
+        self.temp_offset = temp_offset
+        self.humidity_offset = humidity_offset
+
+
+class _Scalar():
+    """Operations on single python numbers"""
+    trunc = int
+
+    @staticmethod
+    def clip(x, lo, hi):
+        return max(min(x, hi), lo)
+
+    @staticmethod
+    def take(table, i):
+        return table[i]
+
+
+class _NumPy():
+    """The same operations elementwise over numpy arrays"""
+    @staticmethod
+    def trunc(x):
+        return numpy.trunc(x)
+
+    @staticmethod
+    def clip(x, lo, hi):
+        return numpy.clip(x, lo, hi)
+
+    @staticmethod
+    def take(table, i):
+        return numpy.asarray(table)[i]
+
+
+def t_fine(cal, adc_temp, ops=_Scalar):
+    var1 = (adc_temp / 8) - (cal.temp[0] * 2)
+    var2 = (var1 * cal.temp[1]) / 2048
+    var3 = ((var1 / 2) * (var1 / 2)) / 4096
+    var3 = (var3 * cal.temp[2] * 16) / 16384
+    return ops.trunc(var2 + var3) + cal.t_fine_offset
+
+
+def temperature(cal, t_fine):
+    """The compensated temperature in degrees Celsius"""
+    calc_temp = ((t_fine * 5) + 128) / 256
+    return (calc_temp / 100) + cal.temp_offset
+
+
+def pressure(cal, t_fine, adc_pres):
+    """The barometric pressure in hectoPascals"""
+    p = cal.pressure
+    var1 = (t_fine / 2) - 64000
+    var2 = ((var1 / 4) * (var1 / 4)) / 2048
+    var2 = (var2 * p[5]) / 4
+    var2 = var2 + (var1 * p[4] * 2)
+    var2 = (var2 / 4) + (p[3] * 65536)
+    var1 = (
+        (((var1 / 4) * (var1 / 4)) / 8192)
+        * (p[2] * 32)
+        / 8
+    ) + ((p[1] * var1) / 2)
+    var1 = var1 / 262144
+    var1 = ((32768 + var1) * p[0]) / 32768
+    calc_pres = 1048576 - adc_pres
+    calc_pres = (calc_pres - (var2 / 4096)) * 3125
+    calc_pres = (calc_pres / var1) * 2
+    var1 = (
+        p[8] * (((calc_pres / 8) * (calc_pres / 8)) / 8192)
+    ) / 4096
+    var2 = ((calc_pres / 4) * p[7]) / 8192
+    var3 = (((calc_pres / 256) ** 3) * p[9]) / 131072
+    calc_pres += (var1 + var2 + var3 + (p[6] * 128)) / 16
+    return calc_pres / 100
+
+
+def humidity(cal, t_fine, adc_hum, ops=_Scalar):
+    """The relative humidity in RH %"""
+    h = cal.humidity
+    temp_scaled = ((t_fine * 5) + 128) / 256
+    var1 = (adc_hum - (h[0] * 16)) - (
+        (temp_scaled * h[2]) / 200
+    )
+    var2 = (
+        h[1]
+        * (
+            ((temp_scaled * h[3]) / 100)
+            + (
+                (
+                    (
+                        temp_scaled
+                        * ((temp_scaled * h[4]) / 100)
+                    )
+                    / 64
+                )
+                / 100
+            )
+            + 16384
+        )
+    ) / 1024
+    var3 = var1 * var2
+    var4 = h[5] * 128
+    var4 = (var4 + ((temp_scaled * h[6]) / 100)) / 16
+    var5 = ((var3 / 16384) * (var3 / 16384)) / 1024
+    var6 = (var4 * var5) / 2
+    calc_hum = (((var3 + var6) / 1024) * 1000) / 4096
+    calc_hum /= 1000  # get back to RH
+
+    return ops.clip(calc_hum, 0, 100) + cal.humidity_offset
+
+
+def gas_resistance(cal, adc_gas, gas_range, ops=_Scalar):
+    """The gas resistance in ohms"""
+    if cal.variant == 0x01:
+        # taken from https://github.com/BoschSensortec/BME68x-Sensor-API
+        var1 = 262144 >> gas_range
+        var2 = adc_gas - 512
+        var2 *= 3
+        var2 = 4096 + var2
+        calc_gas_res = (1000 * var1) / var2
+        calc_gas_res = calc_gas_res * 100
+    else:
+        var1 = (
+            (1340 + (5 * cal.sw_err)) * ops.take(_LOOKUP_TABLE_1, gas_range)
+        ) / 65536
+        var2 = ((adc_gas * 32768) - 16777216) + var1
+        var3 = (ops.take(_LOOKUP_TABLE_2, gas_range) * var1) / 512
+        calc_gas_res = (var3 + (var2 / 2)) / var2
+    return ops.trunc(calc_gas_res)
+
+
+def compensate(cal, raw):
+    """
+    Compensate a batch of raw (adc_temp, adc_pres, adc_hum, adc_gas, gas_range)
+    samples in one pass. Returns (temperature, pressure, humidity, gas)
+    columns: numpy arrays when numpy is available, array('f') otherwise.
+    """
+    if numpy is not None:
+        return _compensate_numpy(cal, raw)
+
+    n = len(raw)
+    temperatures = array('f', [0.0] * n)
+    pressures = array('f', [0.0] * n)
+    humidities = array('f', [0.0] * n)
+    gases = array('f', [0.0] * n)
+    for i, (adc_temp, adc_pres, adc_hum, adc_gas, gas_range) in enumerate(raw):
+        t = t_fine(cal, adc_temp)
+        temperatures[i] = temperature(cal, t)
+        pressures[i] = pressure(cal, t, adc_pres)
+        humidities[i] = humidity(cal, t, adc_hum)
+        gases[i] = gas_resistance(cal, adc_gas, gas_range)
+
+    return temperatures, pressures, humidities, gases
+
+
+def _compensate_numpy(cal, raw):
+    raw = numpy.asarray(raw, dtype=numpy.int64).reshape(-1, 5)
+    adc_temp, adc_pres, adc_hum, adc_gas, gas_range = raw.T
+
+    t = t_fine(cal, adc_temp, _NumPy)
+    return (
+        temperature(cal, t),
+        pressure(cal, t, adc_pres),
+        humidity(cal, t, adc_hum, _NumPy),
+        gas_resistance(cal, adc_gas, gas_range, _NumPy),
+    )
@@ -1,6 +1,8 @@
-import machine, time
+import time
 from struct import pack
 
+import hal
+
 _C8D_READ_PPM = b'\x64\x69\x03\x5e\x4e'
 _C8D_SINGLE_POINT_CALIB = b'\x11\x03\x03'  # followed by data1, data2, checksum
 
@@ -8,8 +10,8 @@ _C8D_MIN_VALUE = 0
 _C8D_MAX_VALUE = 5000
 
 class C8D:
-    def __init__(self, uart_id, baudrate=9600, refresh_rate=3000):
-        self._uart = machine.UART(uart_id, baudrate=baudrate)
+    def __init__(self, uart_id, baudrate=9600, refresh_rate=3000, uart=None):
+        self._uart = uart if uart != None else hal.uart(uart_id, baudrate)
         self._buf = bytearray(14)
 
         self._last_reading = 0
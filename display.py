@@ -1,6 +1,7 @@
 import consolas
 import framebuf
 import machine
+import sensors
 import writer
 
 # Width set assuming 270 degree rotation
@@ -62,44 +63,20 @@ class Display():
             self._writer_red.printstring(text)
 
     def _write_labels(self):
-        self._write_text(' Air Quality', 0, 0, COLOR_BLACK)
-        self._write_text('  CO2', 188, 0, COLOR_BLACK)
-        self._write_text(' Temperature', 0, 42, COLOR_BLACK)
-        self._write_text('Humidity', 188, 42, COLOR_BLACK)
-        self._write_text('Gas Resistance', 0, 84, COLOR_BLACK)
-        self._write_text('Pressure', 188, 84, COLOR_BLACK)
-
-    def _write_iaq(self, iaq):
-        color = COLOR_BLACK
-        if iaq > 150:
-            color = COLOR_RED
-        self._write_text(f'{iaq: >8.0f}', 0, 21, color)
-
-    def _write_co2(self, co2):
-        color = COLOR_BLACK
-        if co2 > 900:
-            color = COLOR_RED
-        self._write_text(f'{co2: >4.0f}ppm', 188, 21, color)
+        for c in sensors.CHANNELS:
+            if c.label != None:
+                self._write_text(c.label, c.x, c.y, COLOR_BLACK)
 
-    def _write_temperature(self, temperature):
+    def _write_value(self, c, value):
         color = COLOR_BLACK
-        if temperature > 30:
+        if c.alert != None and value > c.alert:
             color = COLOR_RED
-        temp_f = int(temperature * 9 / 5 + 32)
-        self._write_text(f'{temperature: >5.0f}C {temp_f:.0f}F', 0, 63, color)
-        self._write_text(f'/', 72, 63, COLOR_BLACK)  # always draw slash with black
-
-    def _write_humidity(self, humidity):
-        color = COLOR_BLACK
-        if humidity > 85:
-            color = COLOR_RED
-        self._write_text(f'{humidity: >5.1f}%', 188, 63, color)
-
-    def _write_gas(self, gas):
-        self._write_text(f'{gas: >8.0f}ohm', 0, 105, COLOR_BLACK)
 
-    def _write_pressure(self, pressure):
-        self._write_text(f'{pressure: >5.0f}hPa', 188, 105, COLOR_BLACK)
+        if callable(c.format):
+            text = c.format(value)
+        else:
+            text = c.format.format(value)
+        self._write_text(text, c.x, c.y + 21, color)
 
     def clear(self, draw=True):
         self._fb_black.fill(COLOR_WHITE)
@@ -107,41 +84,20 @@ class Display():
         if draw:
             self.draw_buffer()
 
-    def _update_values(
-            self,
-            iaq=None,
-            co2=None,
-            temperature=None,
-            humidity=None,
-            gas=None,
-            pressure=None
-    ):
+    def _update_values(self, m):
         self._fb_black.fill(COLOR_WHITE)
         self._fb_red.fill(COLOR_WHITE)
         self._write_labels()
 
-        if iaq is not None:
-            self._write_iaq(iaq)
-        if co2 is not None:
-            self._write_co2(co2)
-        if temperature is not None:
-            self._write_temperature(temperature)
-        if humidity is not None:
-            self._write_humidity(humidity)
-        if gas is not None:
-            self._write_gas(gas)
-        if pressure is not None:
-            self._write_pressure(pressure)
+        for c in sensors.CHANNELS:
+            if c.label != None:
+                self._write_value(c, getattr(m, c.name))
+        # always draw temperature slash with black, after the values so their
+        # space glyphs do not blank it
+        self._write_text(f'/', 72, 63, COLOR_BLACK)
 
     def update(self, m):
-        self._update_values(
-            iaq=m.indoor_air_quality,
-            co2=m.co2,
-            temperature=m.temperature,
-            humidity=m.humidity,
-            gas=m.gas_resistance,
-            pressure=m.pressure,
-        )
+        self._update_values(m)
         self.wake()
         self.draw_buffer()
         self.sleep()
@@ -0,0 +1,39 @@
+"""
+Bus and pin constructors for the drivers, and the board and network calls
+of the metrics server. Every driver accepts already built buses and pins as
+keyword arguments and only falls back to these, so anything with the same
+write/readinto/__call__ methods can stand in for the hardware.
+"""
+
+try:
+    import machine
+except ImportError:
+    machine = None  # on a host, drivers must be given buses, e.g. from mock.py
+
+try:
+    import network
+except ImportError:
+    network = None  # boards without a radio can still drive sensors
+
+def spi(spi_id: int, baudrate: int):
+    return machine.SPI(spi_id, baudrate)
+
+def uart(uart_id: int, baudrate: int):
+    return machine.UART(uart_id, baudrate=baudrate)
+
+def pin_out(pin_id: int, value: int = None, pull_down: bool = False):
+    args = [pin_id, machine.Pin.OUT]
+    if pull_down:
+        args.append(machine.Pin.PULL_DOWN)
+    if value is None:
+        return machine.Pin(*args)
+    return machine.Pin(*args, value=value)
+
+def pin_in(pin_id: int):
+    return machine.Pin(pin_id, machine.Pin.IN)
+
+def ip_address() -> str:
+    return network.WLAN(network.STA_IF).ifconfig()[0]
+
+def reset():
+    machine.reset()
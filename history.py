@@ -0,0 +1,259 @@
+import _thread
+from array import array
+
+import sensors
+from prometheus_express.metric import clock_valid, timestamp
+
+CHANNELS = tuple(c.name for c in sensors.CHANNELS)
+
+# (interval seconds, capacity): 1h of 1m, 6h of 5m, 2d of 1h
+ROLLUPS = (
+    (60, 60),
+    (300, 72),
+    (3600, 48),
+)
+
+
+class Ring():
+    """Fixed-capacity ring of timestamps, oldest first when iterated by position"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('L', [0] * capacity)
+        self.head = 0  # next slot to write
+        self.count = 0
+
+    def _advance(self) -> int:
+        slot = self.head
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return slot
+
+    def _slot(self, i: int) -> int:
+        """Slot of the i-th oldest entry"""
+        return (self.head - self.count + i) % self.capacity
+
+    def _first_at(self, t: int) -> int:
+        """Position of the first entry at or after t"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._slot(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, start: int, end: int):
+        """Slots of the entries with start <= time < end, in time order"""
+        for i in range(self._first_at(start), self.count):
+            slot = self._slot(i)
+            if self.times[slot] >= end:
+                return
+            yield slot
+
+
+class Samples(Ring):
+    """Raw readings, one array('f') column per channel"""
+    def __init__(self, channels, capacity):
+        super().__init__(capacity)
+        self.columns = [array('f', [0.0] * capacity) for _ in channels]
+
+    def append(self, t: int, values) -> None:
+        if self.count > 0 and t < self.times[self._slot(self.count - 1)]:
+            return  # keep times ordered for _first_at if the clock stepped back
+
+        slot = self._advance()
+        self.times[slot] = t
+        for column, v in zip(self.columns, values):
+            column[slot] = v
+
+    def query(self, start: int, end: int):
+        for slot in self._range(start, end):
+            yield self.times[slot], tuple(c[slot] for c in self.columns)
+
+
+class Rollup(Ring):
+    """Readings aggregated into fixed intervals with min, max and mean per channel"""
+    def __init__(self, channels, interval, capacity):
+        super().__init__(capacity)
+        self.interval = interval
+        self.mins = [array('f', [0.0] * capacity) for _ in channels]
+        self.maxs = [array('f', [0.0] * capacity) for _ in channels]
+        self.sums = [array('f', [0.0] * capacity) for _ in channels]
+        self.counts = array('H', [0] * capacity)
+        self._current = -1
+
+    def add(self, t: int, values) -> None:
+        start = t - t % self.interval
+        if self.count > 0 and start < self.times[self._current]:
+            return
+
+        if self.count == 0 or self.times[self._current] != start:
+            self._current = self._advance()
+            self.times[self._current] = start
+            self.counts[self._current] = 0
+
+        slot = self._current
+        first = self.counts[slot] == 0
+        for i, v in enumerate(values):
+            if first:
+                self.mins[i][slot] = v
+                self.maxs[i][slot] = v
+                self.sums[i][slot] = v
+            else:
+                self.mins[i][slot] = min(self.mins[i][slot], v)
+                self.maxs[i][slot] = max(self.maxs[i][slot], v)
+                self.sums[i][slot] += v
+        self.counts[slot] = min(self.counts[slot] + 1, 0xFFFF)
+
+    def query(self, start: int, end: int):
+        for slot in self._range(start - start % self.interval, end):
+            n = self.counts[slot]
+            yield (
+                self.times[slot],
+                tuple(c[slot] for c in self.mins),
+                tuple(c[slot] for c in self.maxs),
+                tuple(c[slot] / n for c in self.sums),
+            )
+
+
+class History():
+    """
+    Fixed-size store of sensor readings. Every record() is kept at full
+    resolution in a ring of `capacity` rows and folded into each rollup. All
+    storage is allocated at construction, old rows are overwritten. Writes and
+    queries take a lock, so the server thread never sees a half-written row.
+    """
+    def __init__(self, channels=CHANNELS, capacity=240, rollups=ROLLUPS):
+        self.lock = _thread.allocate_lock()
+        self.channels = tuple(channels)
+        self.samples = Samples(self.channels, capacity)
+        self.rollups = [Rollup(self.channels, i, c) for i, c in rollups]
+
+    def record(self, m, t: int = None) -> None:
+        """Record the channel attributes of a Sensors object, once the clock is set"""
+        if t is None:
+            if not clock_valid():
+                return
+            t = int(timestamp())
+        self.append(t, [getattr(m, c) for c in self.channels])
+
+    def append(self, t: int, values) -> None:
+        """Record one row of channel values taken at unix time t, dropping it if older than the last"""
+        with self.lock:
+            self.samples.append(t, values)
+            for r in self.rollups:
+                r.add(t, values)
+
+    def query(self, start: int, end: int, resolution: int = 0):
+        """
+        Return readings with start <= time < end, oldest first, copied under the
+        lock. A resolution of 0 returns raw (time, values) rows. Otherwise it
+        must match a rollup interval and returns (time, mins, maxs, means) rows.
+        """
+        if resolution == 0:
+            with self.lock:
+                return list(self.samples.query(start, end))
+
+        for r in self.rollups:
+            if r.interval == resolution:
+                with self.lock:
+                    return list(r.query(start, end))
+
+        raise ValueError("No rollup with resolution %ds" % resolution)
+
+    def size(self) -> int:
+        """Bytes held by the store's arrays"""
+        channels = len(self.channels)
+        total = self.samples.capacity * (4 + 4 * channels)
+        for r in self.rollups:
+            total += r.capacity * (4 + 2 + 12 * channels)
+        return total
+
+
+def backfill(h: History, journal, start: int, end: int):
+    """
+    Yield raw (time, values) rows with start <= time < end from the journal on
+    flash, followed by rows still waiting in its write buffer from the History
+    """
+    last = start - 1
+    if journal != None:
+        for t, values in journal.records(start, end):
+            last = t
+            yield t, values
+
+    yield from h.query(last + 1, end)
+
+
+def _columns(channels, resolution: int):
+    if resolution == 0:
+        return list(channels)
+    return ['%s_%s' % (c, a) for a in ('min', 'max', 'mean') for c in channels]
+
+
+def _flatten(row, resolution: int):
+    """Time and values of a raw or rollup row as one flat sequence"""
+    if resolution == 0:
+        return row[0], row[1]
+    return row[0], row[1] + row[2] + row[3]
+
+
+def render_csv(channels, rows, resolution: int = 0, namespace: str = ''):
+    """Yield a header line and one line per row, values in channel order"""
+    yield 'time,%s\n' % ','.join(_columns(channels, resolution))
+    for row in rows():
+        t, values = _flatten(row, resolution)
+        yield '%d,%s\n' % (t, ','.join(repr(v) for v in values))
+
+
+def render_jsonl(channels, rows, resolution: int = 0, namespace: str = ''):
+    """Yield one JSON object per row, NaN values as null"""
+    columns = _columns(channels, resolution)
+    for row in rows():
+        t, values = _flatten(row, resolution)
+        fields = ','.join(
+            '"%s":%s' % (c, repr(v) if v == v else 'null')
+            for c, v in zip(columns, values)
+        )
+        yield '{"time":%d,%s}\n' % (t, fields)
+
+
+def _series(i: int, n: int, resolution: int):
+    """(column, labels) of each series of channel i of n, rollup mean first"""
+    if resolution == 0:
+        return ((i, 'sensor="mean"'),)
+    return (
+        (2 * n + i, 'sensor="mean"'),
+        (i, 'sensor="mean",rollup="min"'),
+        (n + i, 'sensor="mean",rollup="max"'),
+    )
+
+
+def render_openmetrics(channels, rows, resolution: int = 0, namespace: str = ''):
+    """
+    Yield one gauge family per channel with a timestamped sample per row,
+    named and scaled like the live gauges. History holds the mean over
+    sensors, so samples are labeled sensor="mean" like the live mean series
+    and fill its scrape gaps. Rollup min and max add a rollup label and have
+    no live counterpart. Samples of a series have to be contiguous, so rows()
+    is iterated once per series instead of buffering the result.
+    """
+    prefix = namespace + '_' if namespace != '' else ''
+    for i, name in enumerate(channels):
+        c = sensors.CHANNELS[sensors.CHANNEL_INDEX[name]]
+        family = prefix + c.metric
+        yield '# TYPE %s gauge\n' % family
+        yield '# UNIT %s %s\n' % (family, c.unit)
+        for column, labels in _series(i, len(channels), resolution):
+            for row in rows():
+                t, values = _flatten(row, resolution)
+                v = values[column] * c.scale
+                yield '%s{%s} %s %d\n' % (family, labels, repr(v) if v == v else 'NaN', t)
+    yield '# EOF\n'
+
+
+RENDERERS = {
+    'csv': (render_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (render_jsonl, 'application/jsonl; charset=utf-8'),
+    'openmetrics': (render_openmetrics, 'application/openmetrics-text; version=1.0.0; charset=utf-8'),
+}
@@ -0,0 +1,125 @@
+import math
+import struct
+
+_HUMIDITY_REFERENCE = 40.0
+# log gas resistance falls roughly linearly with relative humidity
+_HUMIDITY_SLOPE = 0.03
+
+# baseline smoothing per sample: quick to follow cleaner air, slow to accept dirtier air
+_BURN_IN_RATE = 0.1
+_RISE_RATE = 0.05
+_FALL_RATE = 0.0005
+
+# accuracy is raised once the baseline's average movement per sample settles below this
+_STABLE_DRIFT = 0.001
+_DRIFT_RATE = 0.01
+
+_STATE_FORMAT = '<ffL'  # baseline, drift, samples
+
+ACCURACY_BURN_IN = 0
+ACCURACY_LEARNING = 1
+ACCURACY_STABLE = 2
+ACCURACY_CALIBRATED = 3
+
+
+class IAQ():
+    """
+    Incremental indoor air quality estimate from a stream of gas resistance
+    samples, scored 0 (clean) to 500 like the BME680 driver's burst version.
+    Each update() is O(1). The score is NaN until the first sample, since 0
+    would read as the cleanest air.
+
+    Clean air is tracked as a baseline of humidity compensated log gas
+    resistance, which rises quickly towards cleaner air and falls slowly, so it
+    follows sensor drift without adopting polluted air as the new normal.
+    The first burn_in samples after boot only warm the heater plate, and are
+    used to learn the baseline if none was restored.
+
+    Accuracy follows BSEC's 0-3 scale: burn-in, learning the baseline, stable
+    baseline, and stable for calibrated_after samples in total. With a path the
+    state is saved every save_interval samples and restored on construction.
+    """
+    def __init__(self, path=None, burn_in=300, save_interval=3600, calibrated_after=86400):
+        self.path = path
+        self.burn_in = burn_in
+        self.save_interval = save_interval
+        self.calibrated_after = calibrated_after
+
+        self.baseline = 0.0
+        self.drift = 1.0
+        self.samples = 0  # lifetime, restored with the baseline
+        self.since_boot = 0
+        self.restored = False
+
+        self.score = float('nan')
+        self.accuracy = ACCURACY_BURN_IN
+
+        if path != None:
+            self.load()
+
+    def update(self, gas_resistance: float, humidity: float) -> float:
+        """Fold one gas resistance sample in ohms at humidity in RH % into the
+        estimate and return the new score"""
+        value = math.log(max(gas_resistance, 1)) + _HUMIDITY_SLOPE * (humidity - _HUMIDITY_REFERENCE)
+        self.since_boot += 1
+
+        if self.since_boot <= self.burn_in:
+            if not self.restored:
+                if self.baseline == 0.0:
+                    self.baseline = value
+                self.baseline += (value - self.baseline) * _BURN_IN_RATE
+            self.accuracy = ACCURACY_BURN_IN
+        else:
+            rate = _RISE_RATE if value > self.baseline else _FALL_RATE
+            step = (value - self.baseline) * rate
+            self.baseline += step
+            self.drift += (abs(step) - self.drift) * _DRIFT_RATE
+            self.samples += 1
+
+            if self.drift > _STABLE_DRIFT:
+                self.accuracy = ACCURACY_LEARNING
+            elif self.samples < self.calibrated_after:
+                self.accuracy = ACCURACY_STABLE
+            else:
+                self.accuracy = ACCURACY_CALIBRATED
+
+            if self.path != None and self.samples % self.save_interval == 0:
+                self.save()
+
+        self.score = _score(value - self.baseline, humidity)
+        return self.score
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+
+        if len(data) != struct.calcsize(_STATE_FORMAT):
+            return
+        self.baseline, self.drift, self.samples = struct.unpack(_STATE_FORMAT, data)
+        self.restored = True
+
+    def save(self) -> None:
+        try:
+            with open(self.path, 'wb') as f:
+                f.write(struct.pack(_STATE_FORMAT, self.baseline, self.drift, self.samples))
+        except OSError as err:
+            print('error saving iaq state: {}'.format(err))
+
+
+def _score(deviation: float, humidity: float) -> float:
+    """
+    Score from the log gas resistance relative to its clean air baseline (75%)
+    and humidity away from the 40% ideal (25%), 0 being best
+    """
+    gas_score = 75.0 * min(math.exp(deviation), 1.0)
+
+    humidity_score = 25.0
+    if humidity < 38:
+        humidity_score = 0.25 / _HUMIDITY_REFERENCE * humidity * 100.0
+    elif humidity > 42:
+        humidity_score = ((-0.25 / (100 - _HUMIDITY_REFERENCE) * humidity) + 0.416666) * 100.0
+
+    return (100.0 - gas_score - humidity_score) * 5.0
@@ -0,0 +1,176 @@
+import _thread
+import os
+import struct
+from binascii import crc32
+
+import history
+from prometheus_express.metric import clock_valid, timestamp
+
+_SEGMENT_SUFFIX = '.seg'
+_CRC_SIZE = 4
+
+
+class Journal():
+    """
+    Append-only log of sensor readings on flash. Each reading is a fixed-size
+    record of a timestamp, one float per channel and a CRC32 of both. Records
+    are buffered and written a batch at a time to limit flash wear, into
+    numbered segment files that rotate once full, keeping max_segments files.
+
+    On boot only the newest segment is checked. If it ends in a torn or
+    corrupt record, for example after a brownout mid-write, appends move on to
+    a fresh segment, and readers skip records that fail their CRC.
+
+    Writes and rotation take a lock. Readers only take it to note which
+    records are written, then read those without it, since written records
+    never change.
+    """
+    def __init__(self, path='/log', channels=history.CHANNELS, segment_records=1024, max_segments=8, batch=20):
+        self.path = path
+        self.channels = tuple(channels)
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.batch = batch
+        self.lock = _thread.allocate_lock()
+
+        self._format = '<L%df' % len(self.channels)
+        self.record_size = struct.calcsize(self._format) + _CRC_SIZE
+        self._buf = bytearray(self.record_size * batch)
+        self._view = memoryview(self._buf)
+        self._pending = 0
+
+        self._segment = 0
+        self._records = 0  # records in the current segment
+        self._last = 0  # time of the newest record
+        self._recover()
+
+    def _segment_path(self, n: int) -> str:
+        return '%s/%08d%s' % (self.path, n, _SEGMENT_SUFFIX)
+
+    def _segments(self):
+        """Segment numbers on flash, oldest first"""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            os.mkdir(self.path)
+            return []
+
+        segments = []
+        for name in names:
+            if name.endswith(_SEGMENT_SUFFIX):
+                segments.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+        segments.sort()
+        return segments
+
+    def _valid(self, record) -> bool:
+        body = len(record) - _CRC_SIZE
+        return struct.unpack_from('<L', record, body)[0] == crc32(record[:body]) & 0xFFFFFFFF
+
+    def _recover(self) -> None:
+        segments = self._segments()
+        if len(segments) == 0:
+            return
+
+        self._segment = segments[-1]
+        size = os.stat(self._segment_path(self._segment))[6]
+        records, torn = divmod(size, self.record_size)
+
+        intact = torn == 0
+        if intact and records > 0:
+            # a write interrupted after the size was updated leaves a bad last record
+            last = bytearray(self.record_size)
+            with open(self._segment_path(self._segment), 'rb') as f:
+                f.seek((records - 1) * self.record_size)
+                f.readinto(last)
+            intact = self._valid(last)
+            if intact:
+                self._last = struct.unpack_from('<L', last)[0]
+
+        self._records = records
+        if not intact or records >= self.segment_records:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self._segment += 1
+        self._records = 0
+
+        segments = self._segments()
+        while len(segments) >= self.max_segments:
+            os.remove(self._segment_path(segments.pop(0)))
+
+    def record(self, m, t: int = None) -> None:
+        """
+        Buffer the channel attributes of a Sensors object, writing once a batch
+        is full. Nothing is recorded until the clock is set.
+        """
+        if t is None:
+            if not clock_valid():
+                return
+            t = int(timestamp())
+        self.append(t, [getattr(m, c) for c in self.channels])
+
+    def append(self, t: int, values) -> None:
+        """Buffer one record, dropping it if older than the last so the log stays in time order"""
+        if t < self._last:
+            return
+        self._last = t
+
+        offset = self._pending * self.record_size
+        body = self.record_size - _CRC_SIZE
+        struct.pack_into(self._format, self._buf, offset, t, *values)
+        crc = crc32(self._view[offset:offset + body]) & 0xFFFFFFFF
+        struct.pack_into('<L', self._buf, offset + body, crc)
+
+        self._pending += 1
+        if self._pending == self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered records, splitting the batch across a segment rotation"""
+        with self.lock:
+            written = 0
+            while written < self._pending:
+                if self._records >= self.segment_records:
+                    self._rotate()
+
+                count = min(self._pending - written, self.segment_records - self._records)
+                start = written * self.record_size
+                with open(self._segment_path(self._segment), 'ab') as f:
+                    f.write(self._view[start:start + count * self.record_size])
+
+                written += count
+                self._records += count
+
+            self._pending = 0
+
+    def records(self, start: int = 0, end: int = 0xFFFFFFFF):
+        """
+        Yield valid (time, values) records with start <= time < end, oldest
+        first. Only records written when the call starts are read, segments
+        rotated away meanwhile are skipped.
+        """
+        with self.lock:
+            segments = self._segments()
+            current, written = self._segment, self._records
+
+        record = bytearray(self.record_size)
+        for n in segments:
+            limit = written if n == current else self.segment_records
+            try:
+                f = open(self._segment_path(n), 'rb')
+            except OSError:
+                continue
+
+            with f:
+                while limit > 0 and f.readinto(record) == self.record_size:
+                    limit -= 1
+                    if not self._valid(record):
+                        continue
+                    row = struct.unpack_from(self._format, record)
+                    if start <= row[0] < end:
+                        yield row[0], row[1:]
+
+    def replay(self, h, start: int = 0) -> None:
+        """Restore logged readings into a History"""
+        for t, values in self.records(start):
+            h.append(t, values)
@@ -0,0 +1,25 @@
+import dht, machine, time
+import uasyncio as asyncio
+import bme680, c8d, iaq, prometheus, sensors
+
+s = sensors.Sensors(
+    bme=bme680.BME680(2, 5, estimator=iaq.IAQ('/iaq.bin')),  # keeps the gas baseline across resets
+    c8d=c8d.C8D(2),
+)
+time.sleep(2)
+s.update()
+
+# set up prometheus metrics
+p = prometheus.Prometheus()
+p.update(s)
+
+PROMETHEUS_INTERVAL = 15000  # 15sec
+
+# serving and polling share one event loop, so metrics are never
+# updated in the middle of a scrape
+async def main():
+    s.start()  # poll each sensor at its own rate
+    await p.serve_async()  # may call machine.reset on error
+    await p.poll(s, PROMETHEUS_INTERVAL)
+
+asyncio.run(main())
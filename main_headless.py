@@ -1,9 +1,19 @@
 import dht, machine, time
-import bme680, c8d, prometheus, sensors
+import bme680, c8d, iaq, history, journal, prometheus, sensors
+
+# readings are only recorded once the clock is set, the RTC restarts in 2000 after a reset
+prometheus.sync_clock()
+
+# restore readings logged before the last reset
+h = history.History()  # ~21KB of readings and rollups
+j = journal.Journal()  # up to 256KB of flash, written every 20 readings
+j.replay(h)
 
 s = sensors.Sensors(
-    bme=bme680.BME680(2, 5),
+    bme=bme680.BME680(2, 5, estimator=iaq.IAQ('/iaq.bin')),  # keeps the gas baseline across resets
     c8d=c8d.C8D(2),
+    history=h,
+    journal=j,
 )
 time.sleep(2)
 s.update()
@@ -11,6 +21,7 @@ s.update()
 # set up prometheus metrics
 p = prometheus.Prometheus()
 p.update(s)
+p.serve_history(h, j)
 p.serve()  # may call machine.reset on error
 
 PROMETHEUS_INTERVAL = 15000  # 15sec
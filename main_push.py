@@ -0,0 +1,31 @@
+import dht, machine, time
+import bme680, c8d, prometheus, sensors
+
+PUSH_HOST = '192.168.1.2'
+PUSH_PORT = 9090  # remote write receiver, use 9091 with format='pushgateway'
+
+s = sensors.Sensors(
+    bme=bme680.BME680(2, 5),
+    c8d=c8d.C8D(2),
+)
+time.sleep(2)
+s.update()
+
+# set up prometheus metrics, pushing changes every 4 updates
+p = prometheus.Prometheus()
+p.push(PUSH_HOST, PUSH_PORT, batch=4)  # sets the clock over NTP first
+p.update(s)
+
+PROMETHEUS_INTERVAL = 15000  # 15sec
+def update(t):
+    s.update()
+    p.update(s)
+    s.print()
+
+t0 = machine.Timer(0)
+t0.init(period=PROMETHEUS_INTERVAL, mode=machine.Timer.PERIODIC, callback=update)
+
+# the timer only queues samples, a slow gateway must not stall sampling
+while True:
+    p.flush()
+    time.sleep(1)
@@ -1,4 +1,6 @@
-import machine, time
+import time
+
+import hal
 
 _MHZ19_READ_PPM = b'\xff\x01\x86\x00\x00\x00\x00\x00\x79'
 _MHZ19_ZERO_CALIB = b'\xff\x01\x87\x00\x00\x00\x00\x00\x79'
@@ -7,9 +9,9 @@ _MHZ19_AUTO_CALIB_ON = b'\xff\x01\x79\xa0\x00\x00\x00\x00\x79'
 _MHZ19_AUTO_CALIB_ON = b'\xff\x01\x79\x00\x00\x00\x00\x00\x79'
 
 class MHZ19:
-    def __init__(self, uart_id, baudrate=9600, refresh_rate=3000):
+    def __init__(self, uart_id, baudrate=9600, refresh_rate=3000, uart=None):
         """ A refresh_rate more frequent than 1000ms returns no new data """
-        self._uart = machine.UART(uart_id, baudrate=baudrate)
+        self._uart = uart if uart != None else hal.uart(uart_id, baudrate)
         self._buf = bytearray(9)
 
         self._last_reading = 0
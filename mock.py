@@ -0,0 +1,360 @@
+"""
+Host-side stand-ins for the hardware, for running drivers and the update loop
+on CPython. install() provides the MicroPython builtins the drivers use, and
+a virtual clock behind time.ticks_ms and time.sleep_ms. The mock buses model
+the attached device's registers or protocol and advance the clock by the
+transfer time at their baudrate. Drivers and sleeps therefore run instantly,
+and the clock reports how long the same calls would take on the board.
+
+Buses created with record=True log every transfer. Replay serves a log back
+to a driver, checking that it writes the same bytes. Pins created with
+record=True log every transition with its virtual time, and PinReplay plays
+such a log back.
+"""
+
+import builtins
+import struct
+import sys
+import time
+
+
+class Clock():
+    """
+    Virtual monotonic time in microseconds. It starts at start_ms, because
+    drivers with a refresh interval skip reads until that long after tick 0.
+    """
+    def __init__(self, start_ms: int = 10000):
+        self.now = start_ms * 1000
+
+    def advance(self, us: int) -> None:
+        self.now += int(us)
+
+    def ticks_ms(self) -> int:
+        return self.now // 1000
+
+    def ticks_us(self) -> int:
+        return self.now
+
+    def sleep_ms(self, ms: int) -> None:
+        self.advance(ms * 1000)
+
+    def sleep_us(self, us: int) -> None:
+        self.advance(us)
+
+
+class _MicroPython():
+    """Stand-in for the micropython module"""
+    @staticmethod
+    def const(value):
+        return value
+
+
+def install(clock: Clock = None) -> Clock:
+    """Provide MicroPython's const and time.ticks_* APIs backed by a virtual
+    clock. Call before importing any driver."""
+    if clock is None:
+        clock = Clock()
+
+    builtins.const = _MicroPython.const
+    sys.modules.setdefault('micropython', _MicroPython)
+
+    time.ticks_ms = clock.ticks_ms
+    time.ticks_us = clock.ticks_us
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = clock.sleep_ms
+    time.sleep_us = clock.sleep_us
+    return clock
+
+
+class Pin():
+    """Output or input pin; value is what an input reads"""
+    def __init__(self, value: int = 0, clock: Clock = None, record: bool = False):
+        self._value = value
+        self.clock = clock
+        self.record = record
+        self.log = []  # (time us, value) per transition
+        self.changes = 0
+
+    def __call__(self, value: int = None) -> int:
+        return self.value(value)
+
+    def value(self, value: int = None) -> int:
+        if value is not None and value != self._value:
+            self._value = value
+            self.changes += 1
+            if self.record:
+                self.log.append((0 if self.clock is None else self.clock.now, value))
+        return self._value
+
+    def on(self) -> None:
+        self.value(1)
+
+    def off(self) -> None:
+        self.value(0)
+
+
+class PinReplay(Pin):
+    """
+    Pin that plays back a recorded transition log. Reads see the transitions
+    due by the clock's time, so an input such as a busy line follows its
+    recording. Writes that change the pin must match the next transition.
+    """
+    def __init__(self, log, clock: Clock, value: int = 0):
+        super().__init__(value, clock)
+        self.transitions = list(log)
+        self.position = 0
+
+    def value(self, value: int = None) -> int:
+        if value is None:
+            while self.position < len(self.transitions) and self.transitions[self.position][0] <= self.clock.now:
+                self._value = self.transitions[self.position][1]
+                self.position += 1
+            return self._value
+
+        if value != self._value:
+            if self.position >= len(self.transitions) or self.transitions[self.position][1] != value:
+                raise ValueError('replay pin set to {} at {}, not as recorded'.format(value, self.position))
+            self.position += 1
+        return super().value(value)
+
+
+class Bus():
+    """
+    Byte transport to a device model, costing bits_per_byte / baudrate of
+    virtual time per byte. The model's write(data) takes what the driver sent
+    and read(n) returns what it receives.
+    """
+    bits_per_byte = 8
+
+    def __init__(self, device, clock: Clock, baudrate: int, record: bool = False):
+        self.device = device
+        self.clock = clock
+        self.baudrate = baudrate
+        self.record = record
+        self.log = []
+        self.transfers = 0
+        self.bytes = 0
+
+    def _transfer(self, n: int) -> None:
+        self.transfers += 1
+        self.bytes += n
+        self.clock.advance(n * self.bits_per_byte * 1000000 // self.baudrate)
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._transfer(len(data))
+        if self.record:
+            self.log.append(('w', data))
+        self.device.write(data)
+        return len(data)
+
+    def readinto(self, buf) -> int:
+        data = self.device.read(len(buf))
+        self._transfer(len(data))
+        if self.record:
+            self.log.append(('r', data))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class SPI(Bus):
+    def __init__(self, device, clock: Clock, baudrate: int = 100000, record: bool = False):
+        super().__init__(device, clock, baudrate, record)
+
+
+class UART(Bus):
+    bits_per_byte = 10  # start and stop bits
+
+    def __init__(self, device, clock: Clock, baudrate: int = 9600, record: bool = False):
+        super().__init__(device, clock, baudrate, record)
+
+
+class Replay():
+    """Device model that plays back a recorded bus log"""
+    def __init__(self, log):
+        self.log = list(log)
+        self.position = 0
+
+    def _next(self, op: str):
+        kind, data = self.log[self.position]
+        if kind != op:
+            raise ValueError('replay expected {} at {}, got {}'.format(kind, self.position, op))
+        self.position += 1
+        return data
+
+    def write(self, data: bytes) -> None:
+        expected = self._next('w')
+        if data != expected:
+            raise ValueError('replay write {} differs from recorded {}'.format(data.hex(), expected.hex()))
+
+    def read(self, n: int) -> bytes:
+        return self._next('r')[:n]
+
+
+class RegisterMap():
+    """
+    Bosch style SPI register map: a transfer starting with a byte with bit 7
+    set selects a register to read from, otherwise the transfer is pairs of
+    register and value. SPI addresses are 7 bits, and map to the register at
+    the same address | 0x80 unless the memory page is 1 (BME680 only).
+    """
+    def __init__(self, registers: dict = {}):
+        self.registers = bytearray(256)
+        for address, value in registers.items():
+            self.registers[address] = value
+        self.page = 0
+        self.address = 0
+
+    def _register(self, address: int) -> int:
+        return address if self.page == 1 else address | 0x80
+
+    def write(self, data: bytes) -> None:
+        if len(data) == 1 and data[0] & 0x80:
+            self.address = self._register(data[0] & 0x7F)
+            return
+
+        for i in range(0, len(data) - 1, 2):
+            self.store(self._register(data[i] & 0x7F), data[i + 1])
+
+    def store(self, register: int, value: int) -> None:
+        self.registers[register] = value
+
+    def load(self, register: int) -> int:
+        return self.registers[register]
+
+    def read(self, n: int) -> bytes:
+        data = bytes(self.load((self.address + i) & 0xFF) for i in range(n))
+        self.address = (self.address + n) & 0xFF
+        return data
+
+
+# per device calibration fields in the order of BME680._read_calibration,
+# starting at 0x8A, with those of a typical device
+_BME680_CALIBRATION = struct.pack(
+    '<hbBHhbBhhbbHhhBBBHbbbBbHhbb',
+    26314, 3, 0,  # T2, T3
+    36069, -10401, 88, 0, 6391, -110, 18, 30, 0, -4087, -1627, 30,  # P1-P10
+    0, 63, 12966, 0, 45, 20, 120, -100,  # H2 msb, H2 lsb and H1, H3-H7
+    26223, -11000, -20, 18,  # T1, G2, G1, G3
+)
+
+# raw (adc_temp, adc_pres, adc_hum, adc_gas, gas_range) of a 22C, 1010hPa, 41% reading
+BME680_SAMPLE = (489700, 359000, 21100, 400, 5)
+
+
+class BME680(RegisterMap):
+    """
+    BME680 register map. Writing forced mode to ctrl_meas starts a measurement
+    that completes after the datasheet TPHG duration of the configured
+    oversampling and heater wait. Until then meas_status reports measuring;
+    afterwards the data registers hold the next raw sample. samples is any
+    iterator of raw tuples and repeats BME680_SAMPLE by default.
+    """
+    def __init__(self, clock: Clock, samples=None, variant: int = 0x00):
+        super().__init__({0xD0: 0x61, 0xF0: variant, 0x02: 0x10, 0x00: 0x40, 0x04: 0x20})
+        for i, b in enumerate(_BME680_CALIBRATION[:24]):
+            self.registers[0x8A + i] = b
+        for i, b in enumerate(_BME680_CALIBRATION[24:]):
+            self.registers[0xE1 + i] = b
+
+        self.clock = clock
+        self.samples = samples
+        self.variant = variant
+        self.done = None
+        self.measurements = 0
+
+    def store(self, register: int, value: int) -> None:
+        if register & 0x7F == 0x73:
+            # the status register is mirrored in both pages
+            self.page = (value >> 4) & 0x01
+            self.registers[0x73] = self.registers[0xF3] = value
+            return
+
+        super().store(register, value)
+        if register == 0x74 and value & 0x03 == 0x01:
+            self.done = self.clock.now + self.duration()
+        elif register == 0xE0 and value == 0xB6:
+            self.page = 0
+
+    def duration(self) -> int:
+        """TPHG duration in us for the configured oversampling and heater"""
+        samplerates = (0, 1, 2, 4, 8, 16)
+        ctrl_meas = self.registers[0x74]
+        cycles = (
+            samplerates[min(ctrl_meas >> 5, 5)]
+            + samplerates[min((ctrl_meas >> 2) & 0x07, 5)]
+            + samplerates[min(self.registers[0x72] & 0x07, 5)]
+        )
+        gas_wait = self.registers[0x64]
+        heater = (gas_wait & 0x3F) << (2 * (gas_wait >> 6))
+        return cycles * 1963 + 477 * 9 + 500 + heater * 1000
+
+    def load(self, register: int) -> int:
+        if register == 0x1D and self.done != None:
+            if self.clock.now < self.done:
+                return 0x20  # measuring
+            self._complete()
+        return self.registers[register]
+
+    def _complete(self) -> None:
+        self.done = None
+        self.measurements += 1
+        sample = BME680_SAMPLE if self.samples is None else next(self.samples)
+        adc_temp, adc_pres, adc_hum, adc_gas, gas_range = sample
+
+        r = self.registers
+        r[0x1D] = 0x80  # new data
+        r[0x1F], r[0x20], r[0x21] = adc_pres >> 12, (adc_pres >> 4) & 0xFF, (adc_pres & 0x0F) << 4
+        r[0x22], r[0x23], r[0x24] = adc_temp >> 12, (adc_temp >> 4) & 0xFF, (adc_temp & 0x0F) << 4
+        r[0x25], r[0x26] = adc_hum >> 8, adc_hum & 0xFF
+        gas_lsb = ((adc_gas & 0x03) << 6) | 0x20 | 0x10 | gas_range  # gas valid, heat stable
+        if self.variant == 0x01:
+            r[0x2C], r[0x2D] = adc_gas >> 2, gas_lsb
+        else:
+            r[0x2A], r[0x2B] = adc_gas >> 2, gas_lsb
+
+
+class MHZ19():
+    """MH-Z19 answering each read command with co2 in ppm and temperature in C"""
+    def __init__(self, co2: int = 600, temperature: int = 24):
+        self.co2 = co2
+        self.temperature = temperature
+        self.pending = b''
+
+    def write(self, data: bytes) -> None:
+        if data[:3] == b'\xff\x01\x86':
+            response = bytearray((0xFF, 0x86, self.co2 >> 8, self.co2 & 0xFF, self.temperature + 40, 0, 0, 0, 0))
+            response[8] = (0xFF - (sum(response[1:8]) & 0xFF) + 1) & 0xFF
+            self.pending += response
+
+    def read(self, n: int) -> bytes:
+        data, self.pending = self.pending[:n], self.pending[n:]
+        return data
+
+
+class C8D():
+    """Cubic CM1106 style C8D answering each read command with co2 in ppm"""
+    def __init__(self, co2: int = 600):
+        self.co2 = co2
+        self.pending = b''
+
+    def write(self, data: bytes) -> None:
+        if data == b'\x64\x69\x03\x5e\x4e':
+            response = bytearray(14)
+            response[0], response[1] = 0x64, 0x69
+            response[4], response[5] = self.co2 & 0xFF, self.co2 >> 8
+            self.pending += response
+
+    def read(self, n: int) -> bytes:
+        data, self.pending = self.pending[:n], self.pending[n:]
+        return data
+
+
+class Sink():
+    """Device that accepts any write and reads as zeros, e.g. a display"""
+    def write(self, data: bytes) -> None:
+        pass
+
+    def read(self, n: int) -> bytes:
+        return bytes(n)
@@ -1,82 +1,175 @@
-import machine, network, _thread
+import time, _thread
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import hal, history, sensors
 import prometheus_express as prometheus
+from prometheus_express.router import response
+
+def sync_clock(attempts=3):
+    """ Set the RTC from NTP, returns whether the clock now holds a plausible time """
+    import ntptime
+    for _ in range(attempts):
+        try:
+            ntptime.settime()
+            break
+        except OSError as err:
+            print('error setting clock: {}'.format(err))
+            time.sleep(1)
+
+    return prometheus.clock_valid()
 
 class Prometheus():
     def __init__(self):
         self.registry = prometheus.CollectorRegistry(namespace='weather')
-        self.temperature_gauge = prometheus.Gauge(
-            name='temperature_celsius',
-            desc='temperature sensor output',
-            labels=['sensor'],
-            registry=self.registry,
-        )
-        self.humidity_gauge = prometheus.Gauge(
-            name='humidity_ratio',
-            desc='humidity sensor output',
-            labels=['sensor'],
-            registry=self.registry,
-        )
-        self.pressure_gauge = prometheus.Gauge(
-            name='pressure_hectopascals',
-            desc='atmospheric pressure sensor output',
-            labels=['sensor'],
-            registry=self.registry,
-        )
-        self.gas_resistance_gauge = prometheus.Gauge(
-            name='gas_resistance_ohms',
-            desc='metal-oxide gas sensor resistance value',
-            labels=['sensor'],
-            registry=self.registry,
-        )
-        self.indoor_air_quality_gauge = prometheus.Gauge(
-            name='indoor_air_quality_score',
-            desc='score for indoor air quality ranging from 0-500',
-            labels=['sensor'],
-            registry=self.registry,
-        )
-        self.co2_gauge = prometheus.Gauge(
-            name='co2_ppm',
-            desc='co2 sensor output',
-            labels=['sensor'],
-            registry=self.registry,
-        )
+        self.gauges = [
+            prometheus.Gauge(
+                name=c.metric,
+                desc=c.desc,
+                unit=c.unit,
+                labels=['sensor'],
+                registry=self.registry,
+            )
+            for c in sensors.CHANNELS
+        ]
+        self.children = None
+        self.means = None
+        self.pusher = None
+        self.history = None
+        self.journal = None
 
     def update(self, m):
-        if m.dht != None:
-            self.temperature_gauge.labels('dht22').set(m.dht_temperature)
-            self.humidity_gauge.labels('dht22').set(m.dht_humidity / 100.0)
-
-        if m.bme != None:
-            self.temperature_gauge.labels('bme680').set(m.bme_temperature)
-            self.humidity_gauge.labels('bme680').set(m.bme_humidity / 100.0)
-            self.pressure_gauge.labels('bme680').set(m.pressure)
-            self.gas_resistance_gauge.labels('bme680').set(m.gas_resistance)
-            self.indoor_air_quality_gauge.labels('bme680').set(m.indoor_air_quality)
-
-        if m.mhz != None:
-            self.temperature_gauge.labels('mhz19').set(m.mhz_temperature)
-            self.co2_gauge.labels('mhz19').set(m.mhz_co2)
-
-        if m.c8d != None:
-            self.co2_gauge.labels('c8d').set(m.c8d_co2)
-
-    def serve(self, port=80):
-        wlan = network.WLAN(network.STA_IF)
-        ip = wlan.ifconfig()[0]
+        if self.children is None or len(self.children) != len(m.readings):
+            # bind each labeled series once, and again when a driver is added;
+            # updates then go straight to it
+            self.children = [self.gauges[r.channel].labels(r.label) for r in m.readings]
+            # the mean over sensors, as recorded in history, for channels any sensor provides
+            provided = sorted(set(r.channel for r in m.readings))
+            self.means = [(c, self.gauges[c].labels('mean')) for c in provided]
+
+        for i, r in enumerate(m.readings):
+            self.children[i].set(m.values[i] * sensors.CHANNELS[r.channel].scale)
+        for c, child in self.means:
+            child.set(getattr(m, sensors.CHANNELS[c].name) * sensors.CHANNELS[c].scale)
+
+        if self.pusher != None:
+            self.pusher.collect()
+
+    def flush(self):
+        """
+        Send queued samples once a batch is due. The request blocks until the
+        gateway answers or times out, so call this from the main loop rather
+        than the update timer.
+        """
+        if self.pusher != None and self.pusher.due():
+            self.pusher.flush()
+
+    def push(self, host, port, format='remote_write', batch=4):
+        """
+        Push changed series every batch updates instead of serving scrapes.
+        remote_write samples carry timestamps, so the clock is set first.
+        """
+        if not sync_clock():
+            print('clock is not set, samples are held back until it is')
+
+        self.pusher = prometheus.Pusher(
+            self.registry,
+            host,
+            port,
+            format=format,
+            instance=hal.ip_address(),
+            batch=batch,
+        )
+
+    def serve_history(self, h, journal=None):
+        """ Serve recorded readings at /history, raw rows come from the journal if given """
+        self.history = h
+        self.journal = journal
+
+    def _history_handler(self, headers, body):
+        """
+        GET /history?start=&end=&resolution=&format= streams readings with
+        start <= time < end (unix seconds, default the last hour) as csv, jsonl
+        or openmetrics. A resolution of 0 returns raw rows, otherwise the
+        rollup with that interval in seconds.
+
+        openmetrics output is grouped by series, so a raw query reads the
+        journal on flash once per channel. Keep its range short.
+        """
+        params = prometheus.parse_query(headers['query'])
+        try:
+            end = int(params.get('end', int(prometheus.timestamp()) + 1))
+            start = int(params.get('start', end - 3600))
+            resolution = int(params.get('resolution', 0))
+            render, type = history.RENDERERS[params.get('format', 'csv')]
+            if resolution != 0:
+                self.history.query(start, end, resolution)  # reject unknown rollups before streaming
+        except (KeyError, ValueError) as err:
+            return response('invalid history query: {}'.format(err), '400 Bad Request')
+
+        if resolution == 0:
+            rows = lambda: history.backfill(self.history, self.journal, start, end)
+        else:
+            rows = lambda: self.history.query(start, end, resolution)
+
+        resp = response(render(self.history.channels, rows, resolution, self.registry.namespace))
+        resp['type'] = type
+        return resp
+
+    def _bind(self, port):
+        ip = hal.ip_address()
         print('binding server: {}:{}'.format(ip, port))
 
         self.router = prometheus.Router()
         self.router.register('GET', '/metrics', self.registry.handler)
+        if self.history != None:
+            self.router.register('GET', '/history', self._history_handler)
+        return ip
+
+    def _bind_error(self, err):
+        if err.errno == 112:  # EADDRINUSE
+            print(err)
+            print('resetting device...')
+            hal.reset()
+
+    def serve(self, port=80, keep_alive=False, idle_timeout=2.0):
+        """
+        Serve metrics from a thread. A kept-alive connection waits up to
+        idle_timeout seconds for its next request and holds the only accept
+        slot in the meantime, so keep it well below the scrape interval.
+        """
+        ip = self._bind(port)
         try:
-            self.server = prometheus.start_http_server(port, address=ip, timeout=20.0)
+            self.server = prometheus.start_http_server(
+                port, address=ip, timeout=20.0, keep_alive=keep_alive, idle_timeout=idle_timeout)
         except OSError as err:
-            if err.errno == 112:  # EADDRINUSE
-                print(err)
-                print('resetting device...')
-                machine.reset()
+            self._bind_error(err)
 
         _thread.start_new_thread(self._accept_connections, ())
 
+    async def serve_async(self, port=80, keep_alive=False, idle_timeout=60.0):
+        """ Serve metrics from the running event loop instead of a thread """
+        ip = self._bind(port)
+        try:
+            self.server = await prometheus.start_async_server(
+                self.router, port, address=ip, timeout=20.0, keep_alive=keep_alive, idle_timeout=idle_timeout)
+        except OSError as err:
+            self._bind_error(err)
+
+    async def poll(self, s, interval):
+        """
+        Update metrics every interval ms on the event loop. Sensors polled by
+        their own tasks are only published, otherwise every sensor is read.
+        """
+        while True:
+            if len(s.tasks) > 0:
+                s.publish()
+            else:
+                s.update()
+            self.update(s)
+            await asyncio.sleep(interval / 1000)
+
     def _accept_connections(self):
         while True:
             try:
@@ -1,4 +1,6 @@
-from prometheus_express.metric import render_help, render_labels, render_name, Metric, Counter, Gauge, Summary
+from prometheus_express.metric import clock_valid, render_help, render_labels, render_name, timestamp, Metric, Counter, Gauge, Summary, Histogram
 from prometheus_express.registry import CollectorRegistry
-from prometheus_express.router import Router
-from prometheus_express.server import start_http_server, Server
\ No newline at end of file
+from prometheus_express.router import parse_query, Router
+from prometheus_express.server import start_http_server, RequestParser, RequestTooLarge, Server
+from prometheus_express.async_server import start_async_server, AsyncServer
+from prometheus_express.push import Pusher
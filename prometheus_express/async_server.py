@@ -0,0 +1,154 @@
+import sys
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from prometheus_express.server import http_buffer_size, http_default_type, encode_content, error_status, is_streamed, RequestParser, Server
+
+# CPython transports may hold on to written memoryviews until they are sent,
+# while uasyncio copies them into its output buffer
+copy_views = sys.implementation.name != 'micropython'
+
+# an idle connection only holds its own task, so it can outlast the 15s
+# scrape interval and be reused by the next scrape
+async_idle_timeout = 60.0
+
+
+async def start_async_server(router, port, address='0.0.0.0', depth=2, timeout=5.0, keep_alive=False, idle_timeout=async_idle_timeout, max_requests=16):
+    server = AsyncServer(
+        router,
+        depth=depth,
+        timeout=timeout,
+        keep_alive=keep_alive,
+        idle_timeout=idle_timeout,
+        max_requests=max_requests)
+    server.http_server = await asyncio.start_server(server.handle, address, port, backlog=depth)
+    return server
+
+
+'''
+Event loop HTTP server. Each connection is served by its own task, so several
+scrapers can be handled at once and other tasks on the loop (such as sensor
+polling) never need to lock shared state.
+'''
+class AsyncServer(Server):
+    http_server = False
+
+    def __init__(self, router, depth=2, timeout=5.0, buffer_size=http_buffer_size, keep_alive=False, idle_timeout=async_idle_timeout, max_requests=16):
+        Server.__init__(
+            self,
+            False,
+            buffer_size=buffer_size,
+            keep_alive=keep_alive,
+            idle_timeout=idle_timeout,
+            max_requests=max_requests)
+        self.router = router
+        self.timeout = timeout
+        self.depth = depth
+        self.buffer_size = buffer_size
+        # one buffer per concurrent stream, a shared buffer would be clobbered
+        # while another connection is waiting on drain
+        self.views = [memoryview(bytearray(buffer_size)) for _ in range(depth)]
+        self.parsers = [RequestParser() for _ in range(depth)]
+
+    async def handle(self, reader, writer):
+        if len(self.parsers) > 0:
+            parser = self.parsers.pop()
+            parser.reset()
+        else:
+            parser = RequestParser()
+
+        served = 0
+        try:
+            while True:
+                # between persistent requests the client may idle for longer
+                # than a single request is allowed to take
+                timeout = self.timeout if served == 0 else self.idle_timeout
+                try:
+                    req = await asyncio.wait_for(self.read_request(reader, parser), timeout)
+                except ValueError as err:
+                    await self.send_response_async(writer, error_status(err), str(err), type=http_default_type)
+                    raise
+
+                if req is None:
+                    break
+
+                served += 1
+                resp = self.dispatch(self.router, req[0], req[1])
+                keep_alive = self.persist(resp, served)
+
+                await self.send_response_async(
+                    writer,
+                    resp['status'],
+                    resp['content'],
+                    type=resp['type'],
+                    keep_alive=keep_alive,
+                    extra=resp['headers'])
+
+                if not keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            if served == 0:
+                print('request timeout')
+        except ValueError as err:
+            print('error parsing request: {}'.format(err))
+        except OSError as err:
+            print('Error sending response: {}'.format(err))
+        finally:
+            if len(self.parsers) < self.depth:
+                self.parsers.append(parser)
+
+            writer.close()
+            await writer.wait_closed()
+
+    async def read_request(self, reader, parser):
+        req = parser.parse()
+        while req is None:
+            data = await reader.read(len(parser.buffer) - parser.used)
+            if not data:
+                return None
+
+            parser.feed(data)
+            req = parser.parse()
+
+        return req
+
+    async def send_response_async(self, writer, status, body, type, keep_alive=False, extra=[]):
+        if not is_streamed(body):
+            content_data = encode_content(body)
+            headers = self.format_headers(
+                status=status,
+                type=type,
+                length=len(content_data),
+                keep_alive=keep_alive,
+                extra=extra)
+
+            writer.write(self.encode_headers(headers))
+            writer.write(content_data)
+            await writer.drain()
+            return
+
+        headers = self.format_headers(
+            status=status, type=type, chunked=True, keep_alive=keep_alive, extra=extra)
+        writer.write(self.encode_headers(headers))
+
+        if len(self.views) > 0:
+            view = self.views.pop()
+        else:
+            view = memoryview(bytearray(self.buffer_size))
+
+        try:
+            for data in self.chunks(body, view):
+                if copy_views and isinstance(data, memoryview):
+                    data = bytes(data)  # the view is reused for the next chunk
+                writer.write(data)
+                await writer.drain()
+        finally:
+            if len(self.views) < self.depth:
+                self.views.append(view)
+
+    def close(self):
+        if self.http_server:
+            self.http_server.close()
@@ -0,0 +1,66 @@
+try:
+    import zlib
+    if not hasattr(zlib, 'compressobj'):
+        zlib = None
+except ImportError:
+    zlib = None
+
+try:
+    import deflate, io
+except ImportError:
+    deflate = None
+
+encoding_gzip = 'gzip'
+encoding_deflate = 'deflate'
+
+
+def available():
+    return zlib is not None or deflate is not None
+
+
+'''
+Pick a supported content coding from an Accept-Encoding header, preferring
+gzip. Codings with a q value of zero are treated as refused.
+'''
+def negotiate(accept):
+    if not available() or not accept:
+        return None
+
+    offered = []
+    for part in accept.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        refused = False
+        for p in params[1:]:
+            p = p.strip()
+            if p[:2] == 'q=':
+                try:
+                    refused = float(p[2:]) == 0
+                except ValueError:
+                    refused = True
+
+        if not refused:
+            offered.append(coding)
+
+    for coding in (encoding_gzip, encoding_deflate):
+        if coding in offered:
+            return coding
+
+    return None
+
+
+def compress(data, coding):
+    if zlib is not None:
+        # 31 selects a gzip wrapper, 15 a zlib wrapper as used by HTTP deflate
+        wbits = 31 if coding == encoding_gzip else 15
+        c = zlib.compressobj(9, zlib.DEFLATED, wbits)
+        return c.compress(data) + c.flush()
+
+    if deflate is not None:
+        format = deflate.GZIP if coding == encoding_gzip else deflate.ZLIB
+        stream = io.BytesIO()
+        with deflate.DeflateIO(stream, format) as d:
+            d.write(data)
+        return stream.getvalue()
+
+    raise ValueError('no compression available')
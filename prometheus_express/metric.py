@@ -1,3 +1,24 @@
+import _thread
+import time
+
+from array import array
+from prometheus_express import protobuf
+from prometheus_express.quantile import QuantileWindow
+
+# MicroPython ports with a 2000-01-01 epoch need shifting to unix time
+epoch_offset = 946684800 if time.gmtime(0)[0] == 2000 else 0
+# unix time of 2020-01-01, an RTC behind this has not been set since boot
+timestamp_floor = 1577836800
+
+
+def timestamp():
+    return time.time() + epoch_offset
+
+
+def clock_valid():
+    return timestamp() >= timestamp_floor
+
+
 def render_help(name, desc, type):
     return [
         '# HELP {} {}'.format(name, desc),
@@ -19,6 +40,44 @@ def render_labels(keys, values):
     return '{' + ','.join(labels) + '}'
 
 
+def render_unit(name, unit):
+    if unit == '':
+        return []
+
+    return ['# UNIT {} {}'.format(name, unit)]
+
+
+def render_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+
+    return str(float(bound))
+
+
+def render_estimate(value):
+    if value != value:
+        return 'NaN'
+
+    return str(value)
+
+
+'''
+Index of the first bound that is not less than value. This avoids importing
+bisect, which is not available on the Express platform.
+'''
+def bisect_left(bounds, value):
+    lo = 0
+    hi = len(bounds)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if bounds[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
+
+
 def render_name(namespace, name):
     if namespace != '':
         return '{}_{}'.format(namespace, name)
@@ -55,6 +114,29 @@ def validate_name(name):
         validate_name_char(c, True) for c in tail
     )
 
+'''
+Handle for one labeled series of a metric, returned and cached by
+Metric.labels. Updates through a child go straight to its series, so
+concurrent writers cannot redirect each other's values.
+'''
+class Child(object):
+    def __init__(self, metric, labelValues):
+        self.metric = metric
+        self.labelValues = labelValues
+
+    def inc(self, value):
+        self.metric.inc_series(self.labelValues, value)
+
+    def dec(self, value):
+        self.metric.dec_series(self.labelValues, value)
+
+    def set(self, value):
+        self.metric.set_series(self.labelValues, value)
+
+    def observe(self, value):
+        self.metric.observe_series(self.labelValues, value)
+
+
 '''
 Base class for typed metrics
 '''
@@ -63,8 +145,11 @@ class Metric(object):
     desc = ''
     labelKeys = []
     metricType = 'untyped'
+    protobufField = 5
+    seriesSuffixes = ('',)
+    openMetricsSuffixes = ('',)
 
-    def __init__(self, name, desc, labels=[], registry=False):
+    def __init__(self, name, desc, labels=[], registry=False, unit=''):
         if not validate_name(name):
             raise ValueError('metric name is not valid')
         if not all(validate_name(n) for n in labels):
@@ -73,82 +158,432 @@ class Metric(object):
         self.name = name
         self.desc = desc
         self.labelKeys = labels
+        self.unit = unit
+
+        if unit != '' and not self.family().endswith('_' + unit):
+            raise ValueError('metric name must end with its unit')
 
         self.emptyLabels = (None,) * len(labels)
-        self.labelValues = self.emptyLabels
+        self.children = {}
+        self.lock = _thread.allocate_lock()
         self.values = {}
+        self.series = []
+        self.seriesKeys = []
+        self.updated = {}
+        self.collectors = []
+
+        self.prefixes = {}
+        self.openMetricsPrefixes = {}
+        self.prefixNamespace = None
 
         if registry != False:
             registry.register(self)
 
+    def bind(self, collector):
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def changed(self, labelValues):
+        self.updated[labelValues] = timestamp()
+        for c in self.collectors:
+            c.invalidate()
+
     def labels(self, *labelValues):
-        self.labelValues = labelValues
-        return self
+        child = self.children.get(labelValues)
+        if child is None:
+            if len(labelValues) != len(self.labelKeys):
+                raise ValueError('length of label values must equal label keys')
+
+            child = Child(self, labelValues)
+            self.children[labelValues] = child
+
+        return child
+
+    '''
+    Record a new series in label order, so every render lists series the same
+    way. Label values are compared as strings. Callers hold the lock.
+    '''
+    def add_series(self, labelValues, value):
+        key = tuple(str(v) for v in labelValues)
+        i = bisect_left(self.seriesKeys, key)
+        self.seriesKeys.insert(i, key)
+        self.series.insert(i, labelValues)
+        self.values[labelValues] = value
+
+    def copy_value(self, value):
+        return value
+
+    '''
+    Copy every series under the metric's lock, so rendering never sees a series
+    in the middle of an update.
+    '''
+    def snapshot(self):
+        with self.lock:
+            return [(l, self.copy_value(self.values[l])) for l in self.series]
+
+    '''
+    Metric family name, which OpenMetrics requires without the counter suffix.
+    '''
+    def family(self):
+        if self.metricType == 'counter' and self.name.endswith('_total'):
+            return self.name[:-6]
+
+        return self.name
+
+    '''
+    Return the rendered `name{labels} ` prefixes for a series, one per entry in
+    seriesSuffixes, or openMetricsSuffixes when openMetrics is set. Prefixes are
+    cached by label values until the namespace changes.
+    '''
+    def prefix(self, namespace, labelValues, openMetrics=False):
+        if namespace != self.prefixNamespace:
+            self.prefixes = {}
+            self.openMetricsPrefixes = {}
+            self.prefixNamespace = namespace
+
+        if openMetrics:
+            cache = self.openMetricsPrefixes
+        else:
+            cache = self.prefixes
+
+        if labelValues not in cache:
+            if openMetrics:
+                nn = render_name(namespace, self.family())
+                suffixes = self.openMetricsSuffixes
+            else:
+                nn = render_name(namespace, self.name)
+                suffixes = self.seriesSuffixes
+
+            cache[labelValues] = self.render_prefixes(nn, labelValues, suffixes)
+
+        return cache[labelValues]
+
+    def render_prefixes(self, nn, labelValues, suffixes):
+        ll = render_labels(self.labelKeys, labelValues)
+        return tuple('{}{}{} '.format(nn, s, ll) for s in suffixes)
+
+    def suffix(self, labelValues, timestamps):
+        if timestamps and labelValues in self.updated:
+            return ' {:.3f}'.format(self.updated[labelValues])
+
+        return ''
+
+    '''
+    List every sample as (name, label keys, label values, value), named as in
+    the text format, for pushing series rather than serving them.
+    '''
+    def samples(self, namespace):
+        nn = render_name(namespace, self.name)
+        return [(nn, self.labelKeys, l, v) for l, v in self.snapshot()]
 
     def render(self, namespace):
         return render_help(render_name(namespace, self.name), self.desc, self.metricType)
 
+    def render_openmetrics(self, namespace, timestamps=False):
+        name = render_name(namespace, self.family())
+        return render_help(name, self.desc, self.metricType) + render_unit(name, self.unit)
+
+    '''
+    Encode the metric family as an io.prometheus.client.MetricFamily message.
+    '''
+    def render_protobuf(self, namespace, timestamps=False):
+        metrics = []
+        for l, v in self.snapshot():
+            m = protobuf.label_pairs(self.labelKeys, l) + self.protobuf_value(v)
+            if timestamps and l in self.updated:
+                m += protobuf.varint_field(6, int(self.updated[l] * 1000))
+            metrics.append(m)
+
+        return protobuf.metric_family(
+            render_name(namespace, self.name), self.desc, self.metricType, metrics)
+
+    def protobuf_value(self, value):
+        return protobuf.bytes_field(self.protobufField, protobuf.double_field(1, value))
+
 
 class Counter(Metric):
     metricType = 'counter'
+    protobufField = 3
+    openMetricsSuffixes = ('_total',)
 
     def inc(self, value):
-        if self.labelValues in self.values:
-            self.values[self.labelValues] += value
-        else:
-            self.values[self.labelValues] = value
-
-        self.labelValues = self.emptyLabels
+        self.inc_series(self.emptyLabels, value)
 
     def dec(self, value):
-        if self.labelValues in self.values:
-            self.values[self.labelValues] -= value
-        else:
-            self.values[self.labelValues] = 0 - value
+        self.dec_series(self.emptyLabels, value)
+
+    def inc_series(self, labelValues, value):
+        changed = value != 0
+        with self.lock:
+            if labelValues in self.values:
+                self.values[labelValues] += value
+            else:
+                self.add_series(labelValues, value)
+                changed = True
 
-        self.labelValues = self.emptyLabels
+        if changed:
+            self.changed(labelValues)
+
+    def dec_series(self, labelValues, value):
+        self.inc_series(labelValues, 0 - value)
 
     def render(self, namespace):
         lines = super(Counter, self).render(namespace)
-        for l, v in self.values.items():
-            lines.append('{}{} {}'.format(render_name(
-                namespace, self.name), render_labels(self.labelKeys, l), v))
+        for l, v in self.snapshot():
+            lines.append(self.prefix(namespace, l)[0] + str(v))
+
+        return lines
+
+    def render_openmetrics(self, namespace, timestamps=False):
+        lines = super(Counter, self).render_openmetrics(namespace)
+        for l, v in self.snapshot():
+            lines.append(self.prefix(namespace, l, True)[0] + str(v) + self.suffix(l, timestamps))
 
         return lines
 
 
 class Gauge(Counter):
     metricType = 'gauge'
+    protobufField = 2
+    openMetricsSuffixes = ('',)
 
     def set(self, value):
-        self.values[self.labelValues] = value
-        self.labelValues = self.emptyLabels
+        self.set_series(self.emptyLabels, value)
+
+    def set_series(self, labelValues, value):
+        with self.lock:
+            prev = self.values.get(labelValues)
+            if prev is None:
+                self.add_series(labelValues, value)
+            else:
+                self.values[labelValues] = value
 
+        if prev is None or prev != value:
+            self.changed(labelValues)
 
+
+'''
+Summary of observation count and total. When quantiles are given, each series
+also keeps a QuantileWindow over the last max_age seconds, estimating every
+quantile within the rank error target.
+'''
 class Summary(Metric):
     metricType = 'summary'
+    protobufField = 4
+    seriesSuffixes = ('_count', '_total')
+    openMetricsSuffixes = ('_count', '_sum')
+
+    def __init__(self, name, desc, labels=[], registry=False, unit='', quantiles=(), error=0.1, max_age=600, age_buckets=3):
+        if 'quantile' in labels:
+            raise ValueError('quantile is reserved for summary quantiles')
+        if not all(q >= 0 and q <= 1 for q in quantiles):
+            raise ValueError('quantiles must be between 0 and 1')
+
+        self.quantiles = tuple(sorted(quantiles))
+        self.error = error
+        self.max_age = max_age
+        self.age_buckets = age_buckets
+        self.windows = {}
 
-    def __init__(self, name, desc, labels=[], registry=False):
-        Metric.__init__(self, name, desc, labels, registry=registry)
-        self.values = {
-            self.emptyLabels: (0, 0),
-        }
+        Metric.__init__(self, name, desc, labels, registry=registry, unit=unit)
+        self.add_series(self.emptyLabels, (0, 0))
 
     def observe(self, value):
-        if self.labelValues in self.values:
-            prev = self.values.get(self.labelValues)
-            self.values[self.labelValues] = (prev[0] + 1, prev[1] + value)
-        else:
-            self.values[self.labelValues] = (1, value)
+        self.observe_series(self.emptyLabels, value)
+
+    def observe_series(self, labelValues, value):
+        with self.lock:
+            if labelValues in self.values:
+                prev = self.values.get(labelValues)
+                self.values[labelValues] = (prev[0] + 1, prev[1] + value)
+            else:
+                self.add_series(labelValues, (1, value))
+
+            if len(self.quantiles) > 0:
+                window = self.windows.get(labelValues)
+                if window is None:
+                    window = QuantileWindow(self.error, self.max_age, self.age_buckets)
+                    self.windows[labelValues] = window
+                window.observe(value)
+
+        self.changed(labelValues)
+
+    def render_prefixes(self, nn, labelValues, suffixes):
+        prefixes = Metric.render_prefixes(self, nn, labelValues, suffixes)
+
+        keys = list(self.labelKeys) + ['quantile']
+        return prefixes + tuple(
+            '{}{} '.format(nn, render_labels(keys, labelValues + (str(float(q)),)))
+            for q in self.quantiles
+        )
+
+    def estimate(self, labelValues):
+        if labelValues not in self.windows:
+            return [float('nan')] * len(self.quantiles)
+
+        return self.windows[labelValues].quantiles(self.quantiles)
+
+    '''
+    Copy every series with its quantile estimates, taken under the lock so the
+    estimates match the count and total.
+    '''
+    def snapshot(self):
+        with self.lock:
+            return [(l, self.values[l] + (self.estimate(l),)) for l in self.series]
+
+    def render_series(self, lines, prefixes, value, ts):
+        for i, e in enumerate(value[2]):
+            lines.append(prefixes[2 + i] + render_estimate(e) + ts)
+
+        lines.append(prefixes[0] + str(value[0]) + ts)
+        lines.append(prefixes[1] + str(value[1]) + ts)
+
+    def samples(self, namespace):
+        nn = render_name(namespace, self.name)
+        keys = list(self.labelKeys) + ['quantile']
+        samples = []
+        for l, v in self.snapshot():
+            for q, e in zip(self.quantiles, v[2]):
+                samples.append((nn, keys, l + (str(float(q)),), e))
 
-        self.labelValues = self.emptyLabels
+            samples.append((nn + '_count', self.labelKeys, l, v[0]))
+            samples.append((nn + '_total', self.labelKeys, l, v[1]))
+
+        return samples
 
     def render(self, namespace):
-        nn = render_name(namespace, self.name)
         lines = super(Summary, self).render(namespace)
-        for l, v in self.values.items():
-            ll = render_labels(self.labelKeys, l)
-            lines.append('{}_count{} {}'.format(nn, ll, v[0]))
-            lines.append('{}_total{} {}'.format(nn, ll, v[1]))
+        for l, v in self.snapshot():
+            self.render_series(lines, self.prefix(namespace, l), v, '')
+
+        return lines
+
+    def render_openmetrics(self, namespace, timestamps=False):
+        lines = super(Summary, self).render_openmetrics(namespace)
+        for l, v in self.snapshot():
+            self.render_series(lines, self.prefix(namespace, l, True), v, self.suffix(l, timestamps))
 
         return lines
+
+    def protobuf_value(self, value):
+        quantiles = b''
+        for q, e in zip(self.quantiles, value[2]):
+            quantiles += protobuf.bytes_field(3, (
+                protobuf.double_field(1, q) +
+                protobuf.double_field(2, e)))
+
+        return protobuf.bytes_field(self.protobufField, (
+            protobuf.varint_field(1, value[0]) +
+            protobuf.double_field(2, value[1]) +
+            quantiles))
+
+
+default_buckets = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+'''
+Histogram with fixed bucket bounds. Each series keeps its per-bucket counts in
+an array('L'), with a final slot for the +Inf bucket, and its sum in an
+array('d'), so observing into an existing series does not allocate.
+'''
+class Histogram(Metric):
+    metricType = 'histogram'
+    protobufField = 7
+
+    def __init__(self, name, desc, labels=[], registry=False, unit='', buckets=default_buckets):
+        if 'le' in labels:
+            raise ValueError('le is reserved for histogram buckets')
+
+        bounds = sorted(float(b) for b in buckets)
+        if len(bounds) > 0 and bounds[-1] == float('inf'):
+            bounds = bounds[:-1]
+
+        self.bounds = array('d', bounds)
+        Metric.__init__(self, name, desc, labels, registry=registry, unit=unit)
+
+    def observe(self, value):
+        self.observe_series(self.emptyLabels, value)
+
+    def observe_series(self, labelValues, value):
+        with self.lock:
+            series = self.values.get(labelValues)
+            if series is None:
+                series = (array('L', [0] * (len(self.bounds) + 1)), array('d', [0.0]))
+                self.add_series(labelValues, series)
+
+            series[0][bisect_left(self.bounds, value)] += 1
+            series[1][0] += value
+
+        self.changed(labelValues)
+
+    def copy_value(self, value):
+        return (array('L', value[0]), array('d', value[1]))
+
+    def render_prefixes(self, nn, labelValues, suffixes):
+        keys = list(self.labelKeys) + ['le']
+        prefixes = []
+        for b in self.bounds:
+            ll = render_labels(keys, labelValues + (render_bound(b),))
+            prefixes.append('{}_bucket{} '.format(nn, ll))
+
+        ll = render_labels(keys, labelValues + ('+Inf',))
+        prefixes.append('{}_bucket{} '.format(nn, ll))
+
+        ll = render_labels(self.labelKeys, labelValues)
+        prefixes.append('{}_sum{} '.format(nn, ll))
+        prefixes.append('{}_count{} '.format(nn, ll))
+        return tuple(prefixes)
+
+    def render_series(self, lines, prefixes, series, ts):
+        count = 0
+        for i, c in enumerate(series[0]):
+            count += c
+            lines.append(prefixes[i] + str(count) + ts)
+
+        lines.append(prefixes[-2] + str(series[1][0]) + ts)
+        lines.append(prefixes[-1] + str(count) + ts)
+
+    def samples(self, namespace):
+        nn = render_name(namespace, self.name)
+        keys = list(self.labelKeys) + ['le']
+        bounds = [render_bound(b) for b in self.bounds] + ['+Inf']
+        samples = []
+        for l, v in self.snapshot():
+            count = 0
+            for i, c in enumerate(v[0]):
+                count += c
+                samples.append((nn + '_bucket', keys, l + (bounds[i],), count))
+
+            samples.append((nn + '_sum', self.labelKeys, l, v[1][0]))
+            samples.append((nn + '_count', self.labelKeys, l, count))
+
+        return samples
+
+    def render(self, namespace):
+        lines = super(Histogram, self).render(namespace)
+        for l, v in self.snapshot():
+            self.render_series(lines, self.prefix(namespace, l), v, '')
+
+        return lines
+
+    def render_openmetrics(self, namespace, timestamps=False):
+        lines = super(Histogram, self).render_openmetrics(namespace)
+        for l, v in self.snapshot():
+            self.render_series(lines, self.prefix(namespace, l, True), v, self.suffix(l, timestamps))
+
+        return lines
+
+    def protobuf_value(self, value):
+        buckets = []
+        count = 0
+        for i, b in enumerate(self.bounds):
+            count += value[0][i]
+            buckets.append(protobuf.bytes_field(3, (
+                protobuf.varint_field(1, count) +
+                protobuf.double_field(2, b))))
+
+        count += value[0][-1]
+        return protobuf.bytes_field(self.protobufField, (
+            protobuf.varint_field(1, count) +
+            protobuf.double_field(2, value[1][0]) +
+            b''.join(buckets)))
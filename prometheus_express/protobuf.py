@@ -0,0 +1,69 @@
+import struct
+
+'''
+Minimal protobuf encoding for the io.prometheus.client.MetricFamily messages
+used by the delimited protobuf exposition format.
+'''
+
+wire_varint = 0
+wire_fixed64 = 1
+wire_bytes = 2
+
+# io.prometheus.client.MetricType
+metric_types = {
+    'counter': 0,
+    'gauge': 1,
+    'summary': 2,
+    'untyped': 3,
+    'histogram': 4,
+}
+
+
+def varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def field_key(field, wire):
+    return varint((field << 3) | wire)
+
+
+def varint_field(field, n):
+    return field_key(field, wire_varint) + varint(n)
+
+
+def double_field(field, value):
+    return field_key(field, wire_fixed64) + struct.pack('<d', value)
+
+
+def bytes_field(field, data):
+    return field_key(field, wire_bytes) + varint(len(data)) + data
+
+
+def string_field(field, s):
+    return bytes_field(field, s.encode('utf-8'))
+
+
+def delimited(message):
+    return varint(len(message)) + message
+
+
+def label_pairs(keys, values):
+    return b''.join(
+        bytes_field(1, string_field(1, k) + string_field(2, str(v)))
+        for k, v in zip(keys, values)
+    )
+
+
+def metric_family(name, desc, type, metrics):
+    return (string_field(1, name) +
+            string_field(2, desc) +
+            varint_field(3, metric_types[type]) +
+            b''.join(bytes_field(4, m) for m in metrics))
@@ -0,0 +1,231 @@
+import socket
+
+from prometheus_express import protobuf
+from prometheus_express.metric import clock_valid, timestamp
+from prometheus_express.registry import exposition_break
+from prometheus_express.server import http_break, http_encoding
+
+push_remote_write = 'remote_write'
+push_gateway = 'pushgateway'
+
+
+'''
+Frame data as a snappy block made only of literals. This is valid input for
+any snappy decoder and avoids running a compressor on the device.
+'''
+def snappy_literals(data):
+    out = [protobuf.varint(len(data))]
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(bytes([n << 2]))
+        elif n < 256:
+            out.append(bytes([60 << 2, n]))
+        else:
+            out.append(bytes([61 << 2, n & 0xFF, n >> 8]))
+        out.append(chunk)
+
+    return b''.join(out)
+
+
+def same_value(a, b):
+    # NaN quantiles of an empty window never compare equal to themselves
+    return a == b or (a != a and b != b)
+
+
+'''
+Send one HTTP/1.1 request and return the response status code.
+'''
+def http_request(host, port, method, path, headers, body, timeout=10.0):
+    address = socket.getaddrinfo(host, port)[0][-1]
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(address)
+
+        lines = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}:{}'.format(host, port),
+            'Connection: close',
+            'Content-Length: {}'.format(len(body)),
+        ] + headers
+        conn.sendall((http_break.join(lines) + http_break * 2).encode(http_encoding))
+        conn.sendall(body)
+
+        status = b''
+        while b'\r\n' not in status:
+            data = conn.recv(64)
+            if not data:
+                break
+            status += data
+    finally:
+        conn.close()
+
+    start = status.split(b'\r\n')[0].split(b' ')
+    if len(start) < 2:
+        raise ValueError('response does not have a status line')
+
+    return int(start[1])
+
+
+'''
+Push registry samples instead of waiting to be scraped. collect() is called
+once per update cycle and queues only the series whose value changed since
+the last cycle. Once batch cycles have been collected, due() is true and
+flush() sends the queue in a single request, so the radio can idle in
+between. collect() never touches the network, so it can run in a timer
+callback; flush() blocks on the request and belongs in the main loop.
+
+Samples are timestamped from the board clock, so remote_write samples are
+not queued until the clock has been set. A batch rejected with a 4xx status
+other than 429 would be rejected again, so it is dropped instead of retried.
+
+The remote_write format sends every queued sample with its timestamp as a
+snappy-framed WriteRequest. The pushgateway format sends the changed metric
+families in the text format with POST, so families that did not change keep
+their previous values on the gateway.
+'''
+class Pusher():
+    def __init__(self, registry, host, port, path=None, format=push_remote_write, job='weather', instance='', batch=4, max_pending=32, timeout=10.0):
+        if format not in (push_remote_write, push_gateway):
+            raise ValueError('unknown push format: {}'.format(format))
+
+        if path is None:
+            if format == push_remote_write:
+                path = '/api/v1/write'
+            else:
+                path = '/metrics/job/{}'.format(job)
+                if instance != '':
+                    path += '/instance/{}'.format(instance)
+
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.path = path
+        self.format = format
+        self.job = job
+        self.instance = instance
+        self.batch = batch
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self.last = {}
+        self.pending = {}
+        self.changed = []
+        self.cycles = 0
+
+    def collect(self):
+        if self.format == push_remote_write and not clock_valid():
+            print('clock is not set, not collecting samples')
+            return
+
+        now = int(timestamp() * 1000)
+        for m in self.registry.metrics:
+            family_changed = False
+            for name, keys, values, value in m.samples(self.registry.namespace):
+                key = (name, values)
+                if key in self.last and same_value(self.last[key], value):
+                    continue
+
+                self.last[key] = value
+                family_changed = True
+                if self.format == push_remote_write:
+                    self.queue(key, keys, now, value)
+
+            if family_changed and m not in self.changed:
+                self.changed.append(m)
+
+        self.cycles += 1
+
+    def due(self):
+        return self.cycles >= self.batch
+
+    def queue(self, key, keys, now, value):
+        if key not in self.pending:
+            self.pending[key] = (keys, [])
+
+        samples = self.pending[key][1]
+        samples.append((now, value))
+        if len(samples) > self.max_pending:
+            samples.pop(0)  # drop the oldest sample after repeated failed pushes
+
+    def flush(self):
+        self.cycles = 0
+        if len(self.changed) == 0:
+            return
+
+        # collect() may run from a timer while the request is in flight, so
+        # send a detached queue and let it start a new one
+        pending, changed = self.pending, self.changed
+        self.pending = {}
+        self.changed = []
+
+        if self.format == push_remote_write:
+            body = snappy_literals(self.write_request(pending))
+            headers = [
+                'Content-Type: application/x-protobuf',
+                'Content-Encoding: snappy',
+                'X-Prometheus-Remote-Write-Version: 0.1.0',
+            ]
+        else:
+            lines = []
+            for m in changed:
+                lines.extend(m.render(self.registry.namespace))
+            body = (exposition_break.join(lines) + exposition_break).encode(http_encoding)
+            headers = ['Content-Type: text/plain; version=0.0.4']
+
+        try:
+            status = http_request(
+                self.host, self.port, 'POST', self.path, headers, body, self.timeout)
+        except (OSError, ValueError) as err:
+            print('error pushing metrics: {}'.format(err))
+            self.requeue(pending, changed)
+            return
+
+        if status < 200 or status >= 300:
+            print('error pushing metrics: status {}'.format(status))
+            if status < 400 or status >= 500 or status == 429:
+                self.requeue(pending, changed)  # retry with the next batch
+
+    '''
+    Put a batch that failed to send back in front of samples queued since.
+    '''
+    def requeue(self, pending, changed):
+        for key, queued in self.pending.items():
+            if key in pending:
+                pending[key][1].extend(queued[1])
+                del pending[key][1][:-self.max_pending]
+            else:
+                pending[key] = queued
+        self.pending = pending
+
+        for m in self.changed:
+            if m not in changed:
+                changed.append(m)
+        self.changed = changed
+
+    '''
+    Encode queued samples as a prometheus.WriteRequest message.
+    '''
+    def write_request(self, pending):
+        series = []
+        for key, queued in pending.items():
+            labels = [('__name__', key[0])]
+            labels.extend(zip(queued[0], key[1]))
+            labels.append(('job', self.job))
+            if self.instance != '':
+                labels.append(('instance', self.instance))
+            labels.sort()
+
+            ts = b''.join(
+                protobuf.bytes_field(1, protobuf.string_field(1, k) + protobuf.string_field(2, str(v)))
+                for k, v in labels
+            )
+            ts += b''.join(
+                protobuf.bytes_field(2, protobuf.double_field(1, v) + protobuf.varint_field(2, t))
+                for t, v in queued[1]
+            )
+            series.append(protobuf.bytes_field(1, ts))
+
+        return b''.join(series)
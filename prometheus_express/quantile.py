@@ -0,0 +1,237 @@
+import math
+import time
+
+from array import array
+
+# observations buffered per age bucket before they are merged into its digest
+quantile_buffer_size = 32
+# largest digest a window may keep per age bucket, ~3KB each
+quantile_max_centroids = 256
+
+
+'''
+Number of centroids a merging t-digest needs so that every quantile estimate
+is within error of its true rank. With the k1 scale function a centroid spans
+at most pi / compression of the ranks, at the median, and interpolating
+within it halves that.
+'''
+def digest_size(error):
+    if error <= 0 or error >= 1:
+        raise ValueError('quantile error must be between 0 and 1')
+
+    size = int(math.ceil(math.pi / (2 * error)))
+    if size > quantile_max_centroids:
+        raise ValueError('quantile error {} needs more than {} centroids'.format(error, quantile_max_centroids))
+
+    return size
+
+
+'''
+Sliding time window of observations for quantile estimation. The window is
+split into age buckets that are rotated out as they expire. Each bucket is a
+merging t-digest: observations are buffered, then sorted and merged into a
+sorted list of weighted centroids, whose size is bounded by the k1 scale
+function so centroids stay small near the tails. Every array is allocated
+once, so observing never allocates and memory is fixed at about
+(size * 12 + buffer * 8) * age_buckets bytes.
+'''
+class QuantileWindow():
+    def __init__(self, error=0.1, max_age=600, age_buckets=3, buffer_size=quantile_buffer_size):
+        if age_buckets < 1:
+            raise ValueError('quantile window needs at least one age bucket')
+
+        self.size = digest_size(error)
+        self.buffer_size = buffer_size
+        self.step = 2 * math.pi / self.size
+        self.age_buckets = age_buckets
+        self.max_age = max_age
+        self.interval = max_age / age_buckets
+
+        self.means = array('d', [0.0] * (self.size * age_buckets))
+        self.weights = array('L', [0] * (self.size * age_buckets))
+        self.centroids = array('H', [0] * age_buckets)
+        self.buffer = array('d', [0.0] * (buffer_size * age_buckets))
+        self.buffered = array('H', [0] * age_buckets)
+        self.seen = array('L', [0] * age_buckets)
+        self.mins = array('d', [0.0] * age_buckets)
+        self.maxs = array('d', [0.0] * age_buckets)
+
+        # merge output, copied back into the bucket
+        self.merged_means = array('d', [0.0] * self.size)
+        self.merged_weights = array('L', [0] * self.size)
+
+        self.head = 0
+        self.rotated = time.time()
+
+    def clear(self, b):
+        self.centroids[b] = 0
+        self.buffered[b] = 0
+        self.seen[b] = 0
+
+    def rotate(self, now):
+        if now - self.rotated >= self.max_age:
+            for b in range(self.age_buckets):
+                self.clear(b)
+            self.rotated = now
+            return
+
+        while now - self.rotated >= self.interval:
+            self.head = (self.head + 1) % self.age_buckets
+            self.clear(self.head)
+            self.rotated += self.interval
+
+    def observe(self, value):
+        self.rotate(time.time())
+
+        b = self.head
+        if self.seen[b] == 0:
+            self.mins[b] = value
+            self.maxs[b] = value
+        elif value < self.mins[b]:
+            self.mins[b] = value
+        elif value > self.maxs[b]:
+            self.maxs[b] = value
+
+        n = self.buffered[b]
+        self.buffer[b * self.buffer_size + n] = value
+        self.buffered[b] = n + 1
+        self.seen[b] += 1
+
+        if n + 1 == self.buffer_size:
+            self.merge(b)
+
+    '''
+    Fraction of the ranks up to which a centroid starting at q may grow: one
+    unit further along k1(q) = compression / 2pi * asin(2q - 1).
+    '''
+    def limit(self, q):
+        k = math.asin(2 * q - 1) + self.step
+        if k >= math.pi / 2:
+            return 1.0
+
+        return (math.sin(k) + 1) / 2
+
+    '''
+    Merge the bucket's buffered observations into its centroids. The buffer is
+    insertion sorted in place, then both sorted runs are walked together,
+    folding each item into the current centroid while it stays within its
+    size limit.
+    '''
+    def merge(self, b):
+        n = self.buffered[b]
+        if n == 0:
+            return
+
+        buf = self.buffer
+        start = b * self.buffer_size
+        for i in range(start + 1, start + n):
+            v = buf[i]
+            j = i - 1
+            while j >= start and buf[j] > v:
+                buf[j + 1] = buf[j]
+                j -= 1
+            buf[j + 1] = v
+
+        means = self.means
+        weights = self.weights
+        base = b * self.size
+        count = self.centroids[b]
+        total = self.seen[b]
+
+        out_means = self.merged_means
+        out_weights = self.merged_weights
+        out = 0
+
+        i = base
+        i_end = base + count
+        j = start
+        j_end = start + n
+
+        emitted = 0
+        bound = total * self.limit(0.0)
+        mean = 0.0
+        weight = 0
+        while i < i_end or j < j_end:
+            if j >= j_end or (i < i_end and means[i] <= buf[j]):
+                m, w = means[i], weights[i]
+                i += 1
+            else:
+                m, w = buf[j], 1
+                j += 1
+
+            if weight == 0:
+                mean, weight = m, w
+            elif emitted + weight + w <= bound or out == self.size - 1:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                out_means[out] = mean
+                out_weights[out] = weight
+                out += 1
+                emitted += weight
+                bound = total * self.limit(emitted / total)
+                mean, weight = m, w
+
+        out_means[out] = mean
+        out_weights[out] = weight
+        out += 1
+
+        for k in range(out):
+            means[base + k] = out_means[k]
+            weights[base + k] = out_weights[k]
+        self.centroids[b] = out
+        self.buffered[b] = 0
+
+    '''
+    Estimate each of the given quantiles over the window, interpolating
+    between the midpoints of neighbouring centroids and the bucket extremes.
+    Returns NaN for every quantile when the window is empty.
+    '''
+    def quantiles(self, qs):
+        self.rotate(time.time())
+
+        centroids = []
+        total = 0
+        low = float('inf')
+        high = float('-inf')
+        for b in range(self.age_buckets):
+            if self.seen[b] == 0:
+                continue
+
+            self.merge(b)
+            base = b * self.size
+            for i in range(base, base + self.centroids[b]):
+                centroids.append((self.means[i], self.weights[i]))
+            total += self.seen[b]
+            low = min(low, self.mins[b])
+            high = max(high, self.maxs[b])
+
+        if total == 0:
+            return [float('nan')] * len(qs)
+
+        centroids.sort()
+        return [interpolate(centroids, total, low, high, q * total) for q in qs]
+
+
+'''
+Value at rank target of sorted (mean, weight) centroids, each taken to sit at
+the middle of the ranks it covers, with low at rank 0 and high at total.
+'''
+def interpolate(centroids, total, low, high, target):
+    prev_mean = low
+    prev_rank = 0.0
+    seen = 0
+    for mean, weight in centroids:
+        rank = seen + weight / 2
+        if target <= rank:
+            if rank == prev_rank:
+                return mean
+            return prev_mean + (mean - prev_mean) * (target - prev_rank) / (rank - prev_rank)
+
+        prev_mean = mean
+        prev_rank = rank
+        seen += weight
+
+    if total == prev_rank:
+        return high
+    return prev_mean + (high - prev_mean) * (target - prev_rank) / (total - prev_rank)
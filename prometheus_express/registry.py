@@ -1,37 +1,192 @@
+from prometheus_express import compress, protobuf
+from prometheus_express.metric import bisect_left, render_name
 from prometheus_express.router import response
+from prometheus_express.server import http_encoding
 
 exposition_break = '\n'
 
-def name_sort(metric):
-    return metric.name
+format_text = 'text'
+format_openmetrics = 'openmetrics'
+format_protobuf = 'protobuf'
 
+format_types = {
+    format_text: 'text/plain; version=0.0.4; charset=utf-8',
+    format_openmetrics: 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+    format_protobuf: 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited',
+}
+
+'''
+Pick the exposition format from an Accept header, by highest q value and then
+by order of appearance. Falls back to the text format.
+'''
+def negotiate_format(accept):
+    if not accept:
+        return format_text
+
+    best = format_text
+    best_q = -1.0
+    for part in accept.split(','):
+        params = part.split(';')
+        media = params[0].strip().lower()
+        q = 1.0
+        proto = ''
+        encoding = ''
+        for p in params[1:]:
+            k, _, v = p.strip().partition('=')
+            if k == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+            elif k == 'proto':
+                proto = v
+            elif k == 'encoding':
+                encoding = v
+
+        if media == 'application/vnd.google.protobuf':
+            if proto != 'io.prometheus.client.MetricFamily' or encoding != 'delimited':
+                continue
+            format = format_protobuf
+        elif media == 'application/openmetrics-text':
+            format = format_openmetrics
+        elif media in ('text/plain', 'text/*', '*/*'):
+            format = format_text
+        else:
+            continue
+
+        if q > best_q and q > 0:
+            best = format
+            best_q = q
+
+    return best
+
+
+'''
+Metrics are indexed by their full name and kept in name order, so renders are
+stable across scrapes.
+'''
 class CollectorRegistry():
     metrics = []
     namespace = ''
     path = ''
 
-    def __init__(self, metrics=[], namespace=''):
-        self.metrics = set(metrics)
+    def __init__(self, metrics=[], namespace='', timestamps=False):
+        self.metrics = []
+        self.names = []
+        self.index = {}
         self.namespace = namespace
+        self.timestamps = timestamps
+        self.bodies = {}
+        self.compressed = {}
+
+        for m in metrics:
+            self.register(m)
 
     def register(self, metric):
-        if metric in self.metrics:
-            return True
+        name = render_name(self.namespace, metric.name)
+        if name in self.index:
+            if self.index[name] is metric:
+                return True
+            raise ValueError('duplicate metric: {}'.format(name))
 
-        self.metrics.add(metric)
+        i = bisect_left(self.names, name)
+        self.names.insert(i, name)
+        self.metrics.insert(i, metric)
+        self.index[name] = metric
+
+        metric.bind(self)
+        self.invalidate()
         return True
 
-    def render(self, sorted=False):
-        if sorted:
-            metrics = sorted(self.metrics, key=name_sort)
-        else:
-            metrics = self.metrics
+    def invalidate(self):
+        self.bodies = {}
+        self.compressed = {}
 
+    def get(self, name):
+        return self.index.get(render_name(self.namespace, name))
+
+    def render(self):
         output = []
-        for m in metrics:
+        for m in self.metrics:
             output.extend(m.render(self.namespace))
 
         return output
 
+    def render_openmetrics(self):
+        output = []
+        for m in self.metrics:
+            output.extend(m.render_openmetrics(self.namespace, self.timestamps))
+
+        output.append('# EOF')
+        return output
+
+    def render_protobuf(self):
+        return b''.join(
+            protobuf.delimited(m.render_protobuf(self.namespace, self.timestamps))
+            for m in self.metrics
+        )
+
+    '''
+    Render and encode the exposition body in the given format, reusing the
+    previous body until a registered metric changes value. The body is stored
+    in the cache taken before rendering, so if a metric changed meanwhile it
+    lands in the dict invalidate() discarded and is never served.
+    '''
+    def encode(self, format=format_text):
+        bodies = self.bodies
+        body = bodies.get(format)
+        if body is None:
+            if format == format_protobuf:
+                body = self.render_protobuf()
+            elif format == format_openmetrics:
+                lines = self.render_openmetrics()
+                body = (exposition_break.join(lines) + exposition_break).encode(http_encoding)
+            else:
+                body = exposition_break.join(self.render()).encode(http_encoding)
+
+            bodies[format] = body
+
+        return body
+
+    '''
+    Yield the exposition one line at a time, for streaming responses that should
+    not hold the whole body in memory.
+    '''
+    def stream(self):
+        for m in self.metrics:
+            for line in m.render(self.namespace):
+                yield line + exposition_break
+
+    '''
+    Return the exposition body compressed with the given content coding,
+    compressing at most once per change in metric values.
+    '''
+    def encode_compressed(self, coding, format=format_text):
+        key = (format, coding)
+        compressed = self.compressed
+        body = compressed.get(key)
+        if body is None:
+            body = compress.compress(self.encode(format), coding)
+            compressed[key] = body
+
+        return body
+
     def handler(self, headers, body):
-        return response(exposition_break.join(self.render()))
\ No newline at end of file
+        format = negotiate_format(headers.get('accept'))
+        coding = compress.negotiate(headers.get('accept-encoding'))
+        if coding is None:
+            resp = response(self.encode(format))
+            resp['headers'] = ['Vary: Accept']
+        else:
+            resp = response(self.encode_compressed(coding, format))
+            resp['headers'] = [
+                'Content-Encoding: {}'.format(coding),
+                'Vary: Accept, Accept-Encoding',
+            ]
+
+        resp['type'] = format_types[format]
+        return resp
+
+    def stream_handler(self, headers, body):
+        return response(self.stream())
+
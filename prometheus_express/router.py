@@ -13,6 +13,9 @@ def error_handler(headers, body):
 
 
 def bind_middleware(handler, middleware=[]):
+    if len(middleware) == 0:
+        return handler
+
     def invoke(headers, body):
         for m in middleware:
             r = m(headers, body)
@@ -31,38 +34,106 @@ def validate_route(handler):
             callable(handler[2]))
 
 
+def split_path(path):
+    return [s for s in path.split('/') if s != '']
+
+
+'''
+Split a query string into a dict of parameters. Values are not URL decoded,
+later values replace earlier ones with the same key.
+'''
+def parse_query(query):
+    params = {}
+    for pair in query.split('&'):
+        if pair == '':
+            continue
+
+        key, _, value = pair.partition('=')
+        params[key] = value
+
+    return params
+
+
+'''
+Route table for the HTTP servers. Exact routes are kept in a dict keyed by
+(method, path). Paths containing a `*` segment are compiled into a per-method
+tree, where `*` matches exactly one segment, or every remaining segment when it
+is the last one in the route. Middleware is bound to the handler once, at
+registration.
+'''
 class Router():
-    def __init__(self):
-        self.routes = []
+    def __init__(self, middleware=[]):
+        self.routes = {}
+        self.handlers = {}
+        self.tree = {}
+        self.middleware = middleware
 
     def __contains__(self, route):
-        for r in self.routes:
-            if r[0] == route[0] and r[1] == route[1]:
-                return r[2]
+        return self.handlers.get((route[0], route[1]))
 
     def __iter__(self):
-        return self.routes.__iter__()
+        return ((k[0], k[1], h) for k, h in self.routes.items())
 
     def __len__(self):
         return self.routes.__len__()
 
-    def _register(self, route):
-        if validate_route(route):
-            self.routes.append(route)
-        else:
+    def _register(self, route, middleware=[]):
+        if not validate_route(route):
             raise ValueError('invalid route')
 
-    def register(self, method, path, handler):
+        key = (route[0], route[1])
+        if key in self.routes:
+            raise ValueError('duplicate route: {} {}'.format(route[0], route[1]))
+
+        handler = bind_middleware(route[2], self.middleware + middleware)
+        self.routes[key] = route[2]
+        self.handlers[key] = handler
+
+        if '*' in route[1]:
+            segments = split_path(route[1])
+            node = self.tree.setdefault(route[0], {})
+            for s in segments[:-1]:
+                node = node.setdefault(s, {})
+
+            if segments[-1] == '*':
+                node[True] = handler  # trailing wildcard
+            else:
+                node.setdefault(segments[-1], {})[None] = handler
+
+    def register(self, method, path, handler, middleware=[]):
         route = (method, path, handler)
-        self._register(route)
+        self._register(route, middleware)
 
     def register_all(self, routes):
         for r in routes:
             self._register(r)
 
+    def _match(self, node, segments, i):
+        if i == len(segments):
+            return node.get(None)
+
+        child = node.get(segments[i])
+        if child is not None:
+            handler = self._match(child, segments, i + 1)
+            if handler is not None:
+                return handler
+
+        child = node.get('*')
+        if child is not None:
+            handler = self._match(child, segments, i + 1)
+            if handler is not None:
+                return handler
+
+        return node.get(True)
+
     def select(self, method, path):
-        for r in self.routes:
-            if r[0] == method and r[1] == path:
-                return r[2]
+        handler = self.handlers.get((method, path))
+        if handler is not None:
+            return handler
+
+        if method in self.tree:
+            handler = self._match(self.tree[method], split_path(path), 0)
+            if handler is not None:
+                return handler
 
         return error_handler
@@ -4,9 +4,19 @@ http_break = '\r\n'
 http_encoding = 'utf-8'
 http_default_status = '200 OK'
 http_default_type = 'text/plain'
+http_bad_request = '400 Bad Request'
+http_too_large = '413 Payload Too Large'
+http_buffer_size = 512
+http_request_limit = 1024
+http_header_end = b'\r\n\r\n'
+# time allowed for the first request on a connection to arrive
+http_request_timeout = 5.0
+# between kept-alive requests, well below the scrape interval: the blocking
+# server accepts nobody else while a connection idles
+http_idle_timeout = 2.0
 
 
-def start_http_server(port, address='0.0.0.0', depth=2, timeout=5.0):
+def start_http_server(port, address='0.0.0.0', depth=2, timeout=5.0, keep_alive=False, idle_timeout=http_idle_timeout, max_requests=16, request_timeout=http_request_timeout):
     bind_address = (address, port)
 
     http_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -19,74 +29,330 @@ def start_http_server(port, address='0.0.0.0', depth=2, timeout=5.0):
     except OSError as err:
         print('Unable to set socket timeout:', err)
 
-    return Server(http_socket)
+    return Server(
+        http_socket,
+        keep_alive=keep_alive,
+        idle_timeout=idle_timeout,
+        max_requests=max_requests)
 
 
+class RequestTooLarge(ValueError):
+    pass
+
+
+def encode_content(content):
+    if isinstance(content, str):
+        return content.encode(http_encoding)
+
+    return content
+
+
+def error_status(err):
+    if isinstance(err, RequestTooLarge):
+        return http_too_large
+
+    return http_bad_request
+
+
+def is_streamed(content):
+    return not isinstance(content, (str, bytes, bytearray))
+
+
+'''
+Incremental HTTP request parser. Received bytes are accumulated in a fixed
+buffer with feed() until parse() finds a complete request head and body.
+Requests that cannot fit in the buffer are rejected as soon as that is known,
+and bytes past the end of a request are kept for the next pipelined one.
+'''
+class RequestParser():
+    def __init__(self, size=http_request_limit):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self):
+        self.used = 0
+        self.head_end = -1
+
+    def feed(self, data):
+        length = len(data)
+        if self.used + length > len(self.buffer):
+            raise RequestTooLarge('request exceeds {} bytes'.format(len(self.buffer)))
+
+        if self.head_end < 0:
+            # the terminator may straddle the previous and the new data
+            overlap = min(self.used, len(http_header_end) - 1)
+            probe = bytes(self.view[self.used - overlap:self.used]) + data
+            found = probe.find(http_header_end)
+            if found >= 0:
+                self.head_end = self.used - overlap + found
+
+        self.view[self.used:self.used + length] = data
+        self.used += length
+
+    '''
+    Return (headers, body) for the buffered request, or None if more data is
+    needed. Header names are lowercased into the same dict as the method, path,
+    query and HTTP version. The body is returned as raw bytes.
+    '''
+    def parse(self):
+        if self.head_end < 0:
+            if self.used == len(self.buffer):
+                raise RequestTooLarge('request head exceeds {} bytes'.format(len(self.buffer)))
+            return None
+
+        body_start = self.head_end + len(http_header_end)
+        head = bytes(self.view[:self.head_end]).decode(http_encoding)
+        headers = self.parse_head(head)
+
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+            raise ValueError('invalid content length {}'.format(length))
+        if body_start + length > len(self.buffer):
+            raise RequestTooLarge('request body exceeds {} bytes'.format(len(self.buffer) - body_start))
+
+        end = body_start + length
+        if self.used < end:
+            return None
+
+        body = bytes(self.view[body_start:end])
+        self.consume(end)
+        return headers, body
+
+    def consume(self, end):
+        remaining = self.used - end
+        self.view[:remaining] = self.view[end:self.used]
+        self.reset()
+        if remaining > 0:
+            self.feed(bytes(self.view[:remaining]))
+
+    def parse_head(self, head):
+        line_end = head.find(http_break)
+        if line_end < 0:
+            line_end = len(head)
+
+        method_end = head.find(' ', 0, line_end)
+        target_end = head.find(' ', method_end + 1, line_end)
+        if method_end < 0 or target_end < 0:
+            raise ValueError('request does not have all HTTP components')
+
+        http = head[target_end + 1:line_end]
+        if http[:5] != 'HTTP/':
+            raise ValueError('request does not have HTTP/x.y marker')
+
+        path = head[method_end + 1:target_end]
+        query = ''
+        query_start = path.find('?')
+        if query_start >= 0:
+            query = path[query_start + 1:]
+            path = path[:query_start]
+
+        headers = {
+            'method': head[:method_end],
+            'path': path,
+            'query': query,
+            'http': http,
+        }
+
+        pos = line_end + len(http_break)
+        while pos < len(head):
+            line_end = head.find(http_break, pos)
+            if line_end < 0:
+                line_end = len(head)
+
+            sep = head.find(':', pos, line_end)
+            if sep < 0:
+                raise ValueError('malformed header line')
+
+            headers[head[pos:sep].strip().lower()] = head[sep + 1:line_end].strip()
+            pos = line_end + len(http_break)
+
+        return headers
+
+
+'''
+Blocking HTTP server, serving one connection at a time from accept(). The
+first request must arrive within request_timeout seconds. With keep_alive, the
+connection is then held open for up to idle_timeout seconds between requests,
+and while an idle client holds it no other client is accepted, so keep that
+short.
+'''
 class Server():
     http_socket = False
 
-    def __init__(self, http_socket):
+    def __init__(self, http_socket, buffer_size=http_buffer_size, keep_alive=False, idle_timeout=http_idle_timeout, max_requests=16, request_timeout=http_request_timeout):
         self.http_socket = http_socket
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.parser = RequestParser()
+
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.request_timeout = request_timeout
 
     def accept(self, router):
         conn, addr = self.http_socket.accept()
         print('request from {}'.format(addr))
+        conn.settimeout(self.request_timeout)
+
+        self.parser.reset()
+        served = 0
+        try:
+            while True:
+                try:
+                    req = self.read_request(conn, self.parser)
+                except OSError:
+                    if served == 0:
+                        raise
+                    break  # idle timeout between requests
+                except ValueError as err:
+                    self.send_response(conn, error_status(err), str(err), type=http_default_type)
+                    raise
+
+                if req is None:
+                    break
+
+                served += 1
+                resp = self.dispatch(router, req[0], req[1])
+                keep_alive = self.persist(resp, served)
+
+                self.send_response(
+                    conn,
+                    resp['status'],
+                    resp['content'],
+                    type=resp['type'],
+                    keep_alive=keep_alive,
+                    extra=resp['headers'])
+
+                if not keep_alive:
+                    break
+                if served == 1:
+                    conn.settimeout(self.idle_timeout)
+        finally:
+            conn.close()
+
+    '''
+    Read one request from the connection into the parser, returning its
+    (headers, body) or None once the client has closed the connection.
+    '''
+    def read_request(self, conn, parser):
+        req = parser.parse()
+        while req is None:
+            data = conn.recv(len(parser.buffer) - parser.used)
+            if not data:
+                return None
+
+            parser.feed(data)
+            req = parser.parse()
+
+        return req
 
-        req = conn.recv(1024).decode(http_encoding)
-        req_headers, req_body = self.parse_headers(req)
+    def persist(self, resp, served):
+        return (self.keep_alive and
+                resp['keep_alive'] and
+                served < self.max_requests)
 
+    def dispatch(self, router, req_headers, req_body):
         handler = router.select(req_headers['method'], req_headers['path'])
         resp = handler(req_headers, req_body)
 
         if 'type' not in resp:
             resp['type'] = http_default_type
 
-        return self.send_response(
-            conn,
-            resp['status'],
-            resp['content'],
-            type=resp['type'])
+        if 'headers' not in resp:
+            resp['headers'] = []
 
-    def send_response(self, conn, status, body, type):
-        content_data = body.encode(http_encoding)
-        content_length = len(content_data)
+        connection = req_headers.get('connection', '').lower()
+        if req_headers['http'] == 'HTTP/1.0':
+            resp['keep_alive'] = connection == 'keep-alive'
+        else:
+            resp['keep_alive'] = connection != 'close'
 
-        line_break = http_break.encode(http_encoding)
-        headers = self.format_headers(
-            status=status, type=type, length=content_length)
+        if is_streamed(resp['content']) and req_headers['http'] == 'HTTP/1.0':
+            # chunked transfer encoding is not available to HTTP/1.0 clients
+            resp['content'] = b''.join(encode_content(c) for c in resp['content'])
 
-        try:
-            for line in headers:
-                conn.send(line.encode(http_encoding))
-                conn.send(line_break)
+        return resp
 
-            conn.send(line_break)
-            conn.send(content_data)
+    def send_response(self, conn, status, body, type, keep_alive=False, extra=[]):
+        try:
+            if is_streamed(body):
+                self.send_chunked(
+                    conn, status, body, type, keep_alive=keep_alive, extra=extra)
+            else:
+                content_data = encode_content(body)
+                headers = self.format_headers(
+                    status=status,
+                    type=type,
+                    length=len(content_data),
+                    keep_alive=keep_alive,
+                    extra=extra)
 
-            conn.close()
+                conn.sendall(self.encode_headers(headers))
+                conn.sendall(content_data)
         except OSError as err:
             print('Error sending response: {}'.format(err))
 
-    def format_headers(self, status, type, length=0):
-        return [
+    def send_chunked(self, conn, status, lines, type, keep_alive=False, extra=[]):
+        headers = self.format_headers(
+            status=status, type=type, chunked=True, keep_alive=keep_alive, extra=extra)
+        conn.sendall(self.encode_headers(headers))
+
+        for data in self.chunks(lines):
+            conn.sendall(data)
+
+    '''
+    Frame an iterable of str or bytes lines using chunked transfer encoding.
+    Lines are copied into the server's reusable buffer, which is emitted as one
+    chunk whenever the next line would not fit. Yielded buffer views are only
+    valid until the generator is resumed. Concurrent writers must each pass
+    their own buffer view.
+    '''
+    def chunks(self, lines, view=None):
+        if view is None:
+            view = self.view
+
+        size = len(view)
+        used = 0
+        for line in lines:
+            data = encode_content(line)
+            length = len(data)
+
+            if used + length > size:
+                yield from self.chunk(view[:used])
+                used = 0
+
+            if length > size:
+                yield from self.chunk(data)
+            else:
+                view[used:used + length] = data
+                used += length
+
+        if used > 0:
+            yield from self.chunk(view[:used])
+
+        yield b'0\r\n\r\n'
+
+    def chunk(self, data):
+        yield '{:x}{}'.format(len(data), http_break).encode(http_encoding)
+        yield data
+        yield b'\r\n'
+
+    def encode_headers(self, headers):
+        return (http_break.join(headers) + http_break * 2).encode(http_encoding)
+
+    def format_headers(self, status, type, length=0, chunked=False, keep_alive=False, extra=[]):
+        headers = [
             'HTTP/1.1 {}'.format(status),
-            'Connection: close',
+            'Connection: {}'.format('keep-alive' if keep_alive else 'close'),
             'Content-Type: {}'.format(type),
-            'Content-Length: {}'.format(length),
         ]
 
-    def parse_headers(self, req):
-        if 'HTTP/' not in req:
-            raise ValueError('request does not have HTTP/x.y marker')
-
-        lines = req.split(http_break)
-        start = lines[0].split(' ')
-
-        if len(start) < 3:
-            raise ValueError('request does not have all HTTP components')
+        if chunked:
+            headers.append('Transfer-Encoding: chunked')
+        else:
+            headers.append('Content-Length: {}'.format(length))
 
-        return ({
-            'method': start[0],
-            'path': start[1],
-            'http': start[2],
-        }, '')
+        headers.extend(extra)
+        return headers
@@ -1,89 +1,222 @@
 import _thread
+from array import array
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+class Channel():
+    """
+    A kind of reading, averaged over every sensor that provides it. Metric
+    fields describe its prometheus gauge, values are multiplied by scale when
+    exported. Display fields place it on the e-paper screen: a label at
+    (x, y), the value below it as format.format(value) or format(value), in
+    red above alert.
+    """
+    def __init__(self, name, metric, desc, unit, scale=1.0, label=None, x=0, y=0, format='{}', alert=None):
+        self.name = name
+        self.metric = metric
+        self.desc = desc
+        self.unit = unit
+        self.scale = scale
+        self.label = label
+        self.x = x
+        self.y = y
+        self.format = format
+        self.alert = alert
+
+def _celsius_fahrenheit(temperature):
+    if temperature != temperature:
+        return '  nanC  nanF'  # no sensor could be read
+    return f'{temperature: >5.0f}C {int(temperature * 9 / 5 + 32):.0f}F'
+
+CHANNELS = (
+    Channel('temperature', 'temperature_celsius', 'temperature sensor output', 'celsius',
+            label=' Temperature', x=0, y=42, format=_celsius_fahrenheit, alert=30),
+    Channel('humidity', 'humidity_ratio', 'humidity sensor output', 'ratio', scale=0.01,
+            label='Humidity', x=188, y=42, format='{: >5.1f}%', alert=85),
+    Channel('pressure', 'pressure_hectopascals', 'atmospheric pressure sensor output', 'hectopascals',
+            label='Pressure', x=188, y=84, format='{: >5.0f}hPa'),
+    Channel('gas_resistance', 'gas_resistance_ohms', 'metal-oxide gas sensor resistance value', 'ohms',
+            label='Gas Resistance', x=0, y=84, format='{: >8.0f}ohm'),
+    Channel('indoor_air_quality', 'indoor_air_quality_score', 'score for indoor air quality ranging from 0-500', 'score',
+            label=' Air Quality', x=0, y=0, format='{: >8.0f}', alert=150),
+    Channel('co2', 'co2_ppm', 'co2 sensor output', 'ppm',
+            label='  CO2', x=188, y=0, format='{: >4.0f}ppm', alert=900),
+)
+
+CHANNEL_INDEX = {c.name: i for i, c in enumerate(CHANNELS)}
+
+_NAN = float('nan')
+
+# driver name: (metric label, method called before reading, poll interval ms, ((channel, attribute), ...))
+# attributes are read in order, from the measure method's result if it returns one,
+# and called if they are methods
+DRIVERS = {
+    'dht': ('dht22', 'measure', 2000, (
+        ('temperature', 'temperature'),
+        ('humidity', 'humidity'),
+    )),
+    'bme': ('bme680', 'measure', 1000, (
+        ('temperature', 'temperature'),
+        ('humidity', 'humidity'),
+        ('pressure', 'pressure'),
+        ('indoor_air_quality', 'indoor_air_quality'),
+        ('gas_resistance', 'gas_resistance'),
+    )),
+    'mhz': ('mhz19', None, 3000, (
+        ('temperature', 'temperature'),
+        ('co2', 'co2'),
+    )),
+    'c8d': ('c8d', None, 3000, (
+        ('co2', 'co2'),
+    )),
+    'epd': ('wasepd29', None, 60000, (
+        ('temperature', 'temperature'),
+    )),
+}
+
+class Reading():
+    """One channel as read from one driver, e.g. bme temperature"""
+    def __init__(self, sensor, label, channel, attribute):
+        self.sensor = sensor
+        self.label = label
+        self.channel = CHANNEL_INDEX[channel]
+        self.attribute = attribute
+        self.name = sensor + '_' + channel  # Sensors attribute, e.g. bme_temperature
 
 class Sensors():
-    def __init__(self, dht=None, bme=None, mhz=None, c8d=None, epd=None):
-        self.dht = dht
-        self.bme = bme
-        self.mhz = mhz
-        self.c8d = c8d
-        self.epd = epd
-
-        self.dht_temperature = 0
-        self.bme_temperature = 0
-        self.mhz_temperature = 0
-        self.epd_temperature = 0
-        self._temperature_list = []
-        self.temperature = 0  # mean sensor temp
-
-        self.dht_humidity = 0
-        self.bme_humidity = 0
-        self._humidity_list = []
-        self.humidity = 0  # mean sensor humidity
-
-        self.pressure = 0
-        self.gas_resistance = 0
-        self.indoor_air_quality = 0
-
-        self.mhz_co2 = 0
-        self.c8d_co2 = 0
-        self._co2_list = []
-        self.co2 = 0
+    def __init__(self, dht=None, bme=None, mhz=None, c8d=None, epd=None, history=None, journal=None):
+        self.drivers = []  # (name, driver, measure method, poll interval ms)
+        self.tasks = []
+        self.readings = []
+        self.values = array('d')
+        self._sums = array('d', [0.0] * len(CHANNELS))
+        self._counts = array('B', [0] * len(CHANNELS))
+        self._providers = array('B', [0] * len(CHANNELS))  # readings per channel
+
+        for c in CHANNELS:
+            setattr(self, c.name, 0)  # mean over sensors
+
+        for name, driver in (('dht', dht), ('bme', bme), ('mhz', mhz), ('c8d', c8d), ('epd', epd)):
+            setattr(self, name, driver)
+            if driver != None:
+                self.add(name, driver)
+
+        self.history = history
+        self.journal = journal
+
+    def add(self, name, driver, spec=None):
+        """
+        Register a driver providing the channels in spec, which defaults to the
+        DRIVERS entry for name
+        """
+        if spec is None:
+            spec = DRIVERS[name]
+        label, measure, interval, channels = spec
+
+        self.drivers.append((name, driver, measure, interval))
+        for channel, attribute in channels:
+            r = Reading(name, label, channel, attribute)
+            self.readings.append(r)
+            self._providers[r.channel] += 1
+            setattr(self, r.name, 0)
+
+        # sized once per driver, so update() never allocates
+        self.values = array('d', [0.0] * len(self.readings))
+
+    def read(self, name, source=None):
+        """Read every channel of one driver into the snapshot, from source if given"""
+        for n, driver, measure, _ in self.drivers:
+            if n == name and source is None:
+                source = driver
+                if measure != None:
+                    result = getattr(driver, measure)()
+                    if result != None:
+                        source = result
+
+        for i, r in enumerate(self.readings):
+            if r.sensor != name:
+                continue
+
+            value = getattr(source, r.attribute)
+            if callable(value):
+                value = value()
+
+            self.values[i] = value
+            setattr(self, r.name, value)
+
+    def fail(self, name):
+        """Mark every channel of a driver that could not be read as NaN, so it is not published as current"""
+        for i, r in enumerate(self.readings):
+            if r.sensor == name:
+                self.values[i] = _NAN
+                setattr(self, r.name, _NAN)
+
+    def publish(self):
+        """
+        Average the latest readings per channel and record them. Failed (NaN)
+        readings are left out, a channel whose every sensor failed is NaN.
+        """
+        for c in range(len(CHANNELS)):
+            self._sums[c] = 0.0
+            self._counts[c] = 0
+
+        for i, r in enumerate(self.readings):
+            v = self.values[i]
+            if v == v:
+                self._sums[r.channel] += v
+                self._counts[r.channel] += 1
+
+        for c, channel in enumerate(CHANNELS):
+            if self._counts[c] > 0:
+                mean = self._sums[c] / self._counts[c]
+            elif self._providers[c] > 0:
+                mean = _NAN
+            else:
+                mean = 0.0
+            setattr(self, channel.name, mean)
+
+        if self.history != None:
+            self.history.record(self)
+        if self.journal != None:
+            self.journal.record(self)
 
     def update(self):
-        if self.dht != None:
-            self.dht.measure()
-            self.dht_temperature = self.dht.temperature()
-            self.dht_humidity = self.dht.humidity()
-
-            self._temperature_list.append(self.dht_temperature)
-            self._humidity_list.append(self.dht_humidity)
-
-        if self.bme != None:
-            self.bme_temperature = self.bme.temperature
-            self.bme_humidity = self.bme.humidity
-            self.pressure = self.bme.pressure
-            self.indoor_air_quality = self.bme.indoor_air_quality
-            # take gas res after IAQ because IAQ runs the gas heater several times
-            self.gas_resistance = self.bme.gas_resistance
-
-            self._temperature_list.append(self.bme_temperature)
-            self._humidity_list.append(self.bme_humidity)
-
-        if self.mhz != None:
-            self.mhz_temperature = self.mhz.temperature
-            self.mhz_co2 = self.mhz.co2
-
-            self._temperature_list.append(self.mhz_temperature)
-            self._co2_list.append(self.mhz_co2)
-
-        if self.c8d != None:
-            self.c8d_co2 = self.c8d.co2
-            self._co2_list.append(self.c8d_co2)
-
-        if self.epd != None:
-            self.epd_temperature = self.epd.temperature
-            self._temperature_list.append(self.epd_temperature)
-
-        self.temperature = sum(self._temperature_list) / max(len(self._temperature_list), 1)
-        self._temperature_list = []
-
-        self.humidity = sum(self._humidity_list) / max(len(self._humidity_list), 1)
-        self._humidity_list = []
-
-        self.co2 = sum(self._co2_list) / max(len(self._co2_list), 1)
-        self._co2_list = []
+        """Read every driver in turn, then publish"""
+        for name, _, _, _ in self.drivers:
+            self.read(name)
+        self.publish()
+
+    async def poll(self, name, interval):
+        driver = [d for n, d, _, _ in self.drivers if n == name][0]
+        while True:
+            try:
+                if hasattr(driver, 'start_measurement'):
+                    # let the loop run during the conversion
+                    self.read(name, await driver.read())
+                else:
+                    self.read(name)
+            except Exception as err:
+                # keep polling, but stop publishing the last good reading
+                print('error reading {}: {!r}'.format(name, err))
+                self.fail(name)
+            await asyncio.sleep(interval / 1000)
+
+    def start(self, intervals={}):
+        """
+        Poll each driver from its own task on the running event loop, every
+        interval ms from intervals or DRIVERS. The snapshot then always holds
+        the latest reading of every driver and publish() no longer waits on
+        slow sensors, though a single driver read still blocks the loop.
+        """
+        for name, _, _, interval in self.drivers:
+            interval = intervals.get(name, interval)
+            self.tasks.append(asyncio.create_task(self.poll(name, interval)))
 
     def print(self):
         print('--------')
-        print(f'dht temp:  {self.dht_temperature:6.2f} °C')
-        print(f'bme temp:  {self.bme_temperature:6.2f} °C')
-        print(f'mhz temp:  {self.mhz_temperature:6.2f} °C')
-        print(f'epd temp:  {self.epd_temperature:6.2f} °C')
-        print(f'dht humid: {self.dht_humidity:6.1f} %rh')
-        print(f'bme humid: {self.bme_humidity:6.1f} %rh')
-        print(f'pressure:  {self.pressure:7.2f} hpa')
-        print(f'gas res:   {self.gas_resistance:6.0f} ohm')
-        print(f'iaq score: {self.indoor_air_quality:6.0f}')
-        print(f'mhz co2:   {self.mhz_co2:6.0f} ppm')
-        print(f'c8d co2:   {self.c8d_co2:6.0f} ppm')
+        for r in self.readings:
+            print('{:24} {:9.2f}'.format(r.name + ':', getattr(self, r.name)))
         print('--------')
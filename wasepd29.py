@@ -1,9 +1,9 @@
 from micropython import const
 from time import sleep_ms
-import machine
 import framebuf
 import ustruct
 import display
+import hal
 
 # Display resolution
 EPD_WIDTH  = const(128)
@@ -62,13 +62,13 @@ SET_RAMY_POS            = const(0x4F)  # ram-y address position
 BUSY = const(1)  # 0=idle, 1=busy
 
 class EPD:
-    def __init__(self, spi_id, pwr_pin, cs_pin, dc_pin, rst_pin, busy_pin):
-        self.spi = machine.SPI(spi_id, 20_000_000)
-        self.pwr = machine.Pin(pwr_pin, machine.Pin.OUT, machine.Pin.PULL_DOWN)
-        self.cs = machine.Pin(cs_pin, machine.Pin.OUT, value=1)
-        self.dc = machine.Pin(dc_pin, machine.Pin.OUT, value=0)
-        self.rst = machine.Pin(rst_pin, machine.Pin.OUT, value=0)
-        self.busy = machine.Pin(busy_pin, machine.Pin.IN)
+    def __init__(self, spi_id, pwr_pin, cs_pin, dc_pin, rst_pin, busy_pin, spi=None, pwr=None, cs=None, dc=None, rst=None, busy=None):
+        self.spi = spi if spi != None else hal.spi(spi_id, 20_000_000)
+        self.pwr = pwr if pwr != None else hal.pin_out(pwr_pin, pull_down=True)
+        self.cs = cs if cs != None else hal.pin_out(cs_pin, value=1)
+        self.dc = dc if dc != None else hal.pin_out(dc_pin, value=0)
+        self.rst = rst if rst != None else hal.pin_out(rst_pin, value=0)
+        self.busy = busy if busy != None else hal.pin_in(busy_pin)
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
         self.rotate = display.ROTATE_0